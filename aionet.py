@@ -0,0 +1,114 @@
+import asyncio
+import inspect
+import random
+
+from itertools import count
+
+from message import write_message, read_message, write_frame, read_frame
+
+from config import SERVERS
+
+
+class AsyncRaftNet:
+    # asyncio counterpart to RaftNet.  All traffic to a peer is carried
+    # on a single long-lived stream fed from that peer's outbox, so the
+    # node needs no threads at all.  With pipelined=True messages go out
+    # in tagged frames without waiting for each reply.
+    def __init__(self, nodenum: int = None, pipelined: bool = False):
+        # My own address
+        self.nodenum = nodenum
+        self.addr = SERVERS.get(nodenum)
+        if self.addr is None:
+            self.addr = ("localhost", random.randint(20000, 20100))
+
+        self.pipelined = pipelined
+        self.server = None
+        self._outboxes = {}
+        self._senders = {}
+        self.connects = 0
+
+    # Start accepting connections; handle_message may be a plain
+    # function or a coroutine function returning the reply bytes.
+    async def start(self, handle_message):
+        self.server = await asyncio.start_server(
+            lambda reader, writer: self._serve(handle_message, reader, writer),
+            *self.addr,
+            reuse_address=True,
+        )
+
+    async def _serve(self, handle_message, reader, writer):
+        try:
+            while True:
+                request_id, msg = await read_frame(reader)
+                resp = handle_message(msg)
+                if inspect.isawaitable(resp):
+                    resp = await resp
+                write_frame(writer, request_id, resp)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Queue a message for a specific node number.  Delivery is best
+    # effort like RaftNet.send: Raft retries through heartbeats.
+    def send(self, destination: int, message: bytes):
+        outbox = self._outboxes.get(destination)
+        if outbox is None:
+            outbox = self._outboxes[destination] = asyncio.Queue()
+            self._senders[destination] = asyncio.create_task(
+                self._sender(destination, outbox)
+            )
+        outbox.put_nowait(message)
+
+    async def _sender(self, destination, outbox):
+        reader = writer = replies = None
+        request_ids = count(1)
+        try:
+            while True:
+                message = await outbox.get()
+                try:
+                    if writer is None or writer.is_closing():
+                        self.connects += 1
+                        reader, writer = await asyncio.open_connection(
+                            *SERVERS.get(destination)
+                        )
+                        if self.pipelined:
+                            replies = asyncio.create_task(self._drain(reader, writer))
+                    if self.pipelined:
+                        write_frame(writer, next(request_ids), message)
+                        await writer.drain()
+                    else:
+                        write_message(writer, message)
+                        await writer.drain()
+                        await read_message(reader)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    if replies is not None:
+                        replies.cancel()
+                    if writer is not None:
+                        writer.close()
+                    reader = writer = replies = None
+        finally:
+            if replies is not None:
+                replies.cancel()
+            if writer is not None:
+                writer.close()
+
+    # Read and discard replies on a pipelined stream; close it when the
+    # peer goes away so the next send reconnects.
+    async def _drain(self, reader, writer):
+        try:
+            while True:
+                await read_frame(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            writer.close()
+
+    async def close(self):
+        for task in self._senders.values():
+            task.cancel()
+        await asyncio.gather(*self._senders.values(), return_exceptions=True)
+        self._senders.clear()
+        self._outboxes.clear()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,127 @@
+import asyncio
+
+from concurrent.futures import Future
+
+from aionet import AsyncRaftNet
+from codec import CODECS
+from config import SERVERS
+from message import ClockTick
+from controller import RaftController
+from kvserver import KVServer
+from server import (
+    PROPOSAL_BATCH,
+    READ_TIMEOUT,
+    READ_TIMED_OUT,
+    open_log,
+    reply,
+    tick_interval,
+)
+
+
+class AsyncRaftServer:
+    # Event-loop driven RaftServer.  Every received message is handed to
+    # the controller and its queues are drained straight away on the
+    # loop, so there are no incoming/outgoing/per-send threads.  Takes
+    # the same options as RaftServer.
+    def __init__(
+        self,
+        nodenum,
+        leader=False,
+        pipelined=False,
+        codec="pickle",
+        data_dir=None,
+        **options,
+    ):
+        self.nodenum = nodenum
+        role = "FOLLOWER"
+        if leader:
+            role = "LEADER"
+        self.net = AsyncRaftNet(nodenum, pipelined=pipelined)
+        self.dumps, self.loads = CODECS[codec]
+        self.kv = KVServer()
+        options.setdefault("proposal_batch", PROPOSAL_BATCH)
+        options.setdefault("cluster", tuple(SERVERS))
+        self.controller = RaftController(
+            nodenum,
+            role,
+            log=open_log(nodenum, data_dir),
+            state_machine=self.kv,
+            **options,
+        )
+        self._flush_timer = None
+
+    @property
+    def log(self):
+        return self.controller.log.log_entries
+
+    async def start(self):
+        await self.net.start(self.handle_message)
+        self._clock = asyncio.create_task(self.clock())
+
+    async def stop(self):
+        self._clock.cancel()
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        await self.net.close()
+
+    def handle_message(self, msg):
+        msg = self.loads(msg)
+        resp = self.controller.receive(msg)
+        self.process()
+        if isinstance(resp, Future):
+            return self._read(resp)
+        return reply(resp)
+
+    # Wait for the answer to a read without holding up the loop
+    async def _read(self, future):
+        try:
+            resp = await asyncio.wait_for(asyncio.wrap_future(future), READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            resp = READ_TIMED_OUT
+        return reply(resp)
+
+    # Run every queued incoming message through the controller and fan
+    # out whatever it wants sent.  Collected commands are sent by a timer
+    # once their window is up.  With no window that is the next pass of
+    # the event loop, so commands read from every client in this pass go
+    # out together.
+    def process(self):
+        while not self.controller.incoming_messages.empty():
+            try:
+                self.controller.handle_incoming()
+            except Exception:
+                pass
+
+        delay = self.controller.proposal_delay()
+        if delay is not None and self._flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self._flush_timer = loop.call_later(delay, self._flush_proposals)
+
+        while not self.controller.outgoing_messages.empty():
+            msg = self.dumps(self.controller.outgoing_messages.get_nowait())
+            for nodenum in self.controller.peers:
+                self.net.send(nodenum, msg)
+
+    def _flush_proposals(self):
+        self._flush_timer = None
+        if self.controller.proposal_delay() == 0:
+            self.controller.flush_proposals()
+        self.process()
+
+    async def clock(self):
+        while True:
+            delay, interval = tick_interval(self.controller)
+            await asyncio.sleep(delay)
+            self.controller.receive(ClockTick(interval))
+            self.process()
+
+
+async def main():
+    servers = [AsyncRaftServer(nodenum) for nodenum in SERVERS]
+    for server in servers:
+        await server.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
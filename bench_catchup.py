@@ -0,0 +1,44 @@
+# Time for a fresh follower to catch up with a leader's log, passing
+# messages between two in-process controllers.  max_batch_entries=1
+# behaves like the old one-entry-per-response replication.
+#
+#   python bench_catchup.py [entries]
+import sys
+import time
+
+from controller import RaftController
+from log import LogEntry
+
+
+def catch_up(entries, **options):
+    leader = RaftController(1, "LEADER", **options)
+    leader.log.log_entries.extend(LogEntry(0, f"set key{i} {i}") for i in range(entries))
+    follower = RaftController(2)
+
+    start = time.perf_counter()
+    round_trips = 0
+    leader.send_heartbeat()
+    while leader.outgoing_messages.qsize():
+        follower.handle_message(leader.outgoing_messages.get_nowait())
+        while follower.outgoing_messages.qsize():
+            leader.handle_message(follower.outgoing_messages.get_nowait())
+        round_trips += 1
+    elapsed = time.perf_counter() - start
+
+    assert follower.log.log_entries == leader.log.log_entries
+    return elapsed, round_trips
+
+
+def main(entries=100000):
+    print(f"fresh follower catching up on {entries} entries")
+    for name, options in [
+        ("one entry per response", dict(max_batch_entries=1)),
+        ("batched", dict()),
+        ("batched, 8KB cap", dict(max_batch_bytes=8 * 1024)),
+    ]:
+        elapsed, round_trips = catch_up(entries, **options)
+        print(f"{name:>24}: {elapsed:8.3f}s  {round_trips:7d} round trips")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,43 @@
+# Encode/decode throughput and payload size of the binary codec against
+# pickle for each Raft message type.
+#
+#   python bench_codec.py [iterations]
+import sys
+import timeit
+
+from codec import CODECS
+from log import LogEntry
+from message import (
+    AppendEntriesMessage,
+    AppendEntriesResponse,
+    NewCommandMessage,
+    RequestVoteMessage,
+    RequestVoteResponse,
+)
+
+SAMPLES = {
+    "heartbeat": AppendEntriesMessage(41, 7, [], 40, 7),
+    "append x1": AppendEntriesMessage(41, 7, [LogEntry(7, "set key1 value")], 40, 7),
+    "append x100": AppendEntriesMessage(
+        41, 7, [LogEntry(7, f"set key{i} value{i}") for i in range(100)], 40, 7
+    ),
+    "append resp": AppendEntriesResponse(True, 42, 7, 3),
+    "new command": NewCommandMessage("set key1 value"),
+    "vote": RequestVoteMessage(term=8, candidate_id=2, last_log_index=41, last_log_term=7),
+    "vote resp": RequestVoteResponse(True, 8, 4),
+}
+
+
+def main(iterations=20000):
+    print(f"{'message':>12} {'codec':>7} {'bytes':>6} {'encode/s':>10} {'decode/s':>10}")
+    for name, msg in SAMPLES.items():
+        for codec, (dumps, loads) in CODECS.items():
+            data = dumps(msg)
+            assert loads(data) == msg
+            encode = iterations / timeit.timeit(lambda: dumps(msg), number=iterations)
+            decode = iterations / timeit.timeit(lambda: loads(data), number=iterations)
+            print(f"{name:>12} {codec:>7} {len(data):6d} {encode:10.0f} {decode:10.0f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
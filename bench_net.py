@@ -0,0 +1,51 @@
+# Compare messages/sec for the connection modes of RaftNet: the old
+# connect-per-message path, pooled connections that wait for each reply,
+# and a pipelined connection with many requests in flight.
+#
+#   python bench_net.py [messages]
+import sys
+import time
+
+from threading import Thread
+
+from config import SERVERS
+from net import RaftNet
+
+SERVER_NODE = 1
+MODES = {
+    "connect-per-message": dict(pooled=False),
+    "pooled": dict(pooled=True),
+    "pipelined": dict(pipelined=True),
+}
+
+
+def run(options, count):
+    client = RaftNet(**options)
+    start = time.perf_counter()
+    if client.pipelined:
+        futures = [client.send_async(SERVER_NODE, b"x" * 64) for _ in range(count)]
+        for future in futures:
+            future.result()
+    else:
+        for _ in range(count):
+            resp = client.send(SERVER_NODE, b"x" * 64)
+            if isinstance(resp, Exception):
+                raise resp
+    elapsed = time.perf_counter() - start
+    client.close()
+    client.sock.close()
+    return count / elapsed, client.connects, client.reuses
+
+
+def main(count=5000):
+    server = RaftNet(SERVER_NODE)
+    Thread(target=server.receive, args=[lambda msg: b"ok"], daemon=True).start()
+
+    print(f"{count} messages to {SERVERS[SERVER_NODE]}")
+    for mode, options in MODES.items():
+        rate, connects, reuses = run(options, count)
+        print(f"{mode:>20}: {rate:10.0f} msg/s  connects={connects} reuses={reuses}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
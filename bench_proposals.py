@@ -0,0 +1,68 @@
+# Client commands/sec against a five node cluster of AsyncRaftServers
+# on localhost, as the number of concurrent clients grows.  Each client
+# sends its commands one at a time over its own connection to the
+# leader, and the run ends once the leader has committed them all.
+# proposal_batch=1 replicates every command on its own, as before the
+# proposal batcher.
+#
+#   python bench_proposals.py [commands]
+import asyncio
+import pickle
+import sys
+import time
+
+from aioserver import AsyncRaftServer
+from config import SERVERS
+from message import NewCommandMessage, read_message, write_message
+
+LEADER = 1
+CLIENTS = [1, 4, 16, 64]
+
+
+async def client(commands):
+    reader, writer = await asyncio.open_connection(*SERVERS[LEADER])
+    for command in commands:
+        write_message(writer, pickle.dumps(NewCommandMessage(command)))
+        assert await read_message(reader) == b"ok"
+    writer.close()
+
+
+async def run(clients, count, **options):
+    servers = [
+        AsyncRaftServer(nodenum, leader=nodenum == LEADER, pipelined=True, **options)
+        for nodenum in SERVERS
+    ]
+    for server in servers:
+        await server.start()
+    leader = servers[0].controller
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            client([f"set key{n}.{i} {i}" for i in range(count // clients)])
+            for n in range(clients)
+        ]
+    )
+    total = count // clients * clients
+    while leader.commit_index < total:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    for server in servers:
+        await server.stop()
+    return total / elapsed
+
+
+def main(count=4096):
+    print(f"{count} commands to a five node cluster")
+    for name, options in [
+        ("one command per append", dict(proposal_batch=1)),
+        ("batched", dict()),
+    ]:
+        for clients in CLIENTS:
+            rate = asyncio.run(run(clients, count, **options))
+            print(f"{name:>24}, {clients:3d} clients: {rate:9.0f} cmds/s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
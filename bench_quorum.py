@@ -0,0 +1,75 @@
+# Cost of handling one successful AppendEntriesResponse on a leader as
+# the cluster grows, in simulated clusters of 3 to 51 nodes.  Followers
+# answer in a random order with their match index creeping forwards.
+# "sorted" is the old way of finding the commit index, sorting every
+# node's match index on each response; "tracker" is QuorumTracker.
+#
+#   python bench_quorum.py [responses]
+import random
+import sys
+import time
+
+from controller import RaftController
+from log import LogEntry
+from quorum import QuorumTracker
+
+SIZES = [3, 5, 7, 11, 21, 31, 51]
+
+
+def responses(size, count, seed=1):
+    rng = random.Random(seed)
+    match = dict.fromkeys(range(2, size + 1), 0)
+    result = []
+    for _ in range(count):
+        nodenum = rng.randrange(2, size + 1)
+        match[nodenum] += rng.randrange(1, 4)
+        result.append((nodenum, match[nodenum]))
+    return result
+
+
+# The leader (node 1) has every entry
+def sorted_commit(size, updates):
+    match = dict.fromkeys(range(1, size + 1), 0)
+    match[1] = max(index for _, index in updates)
+    quorum = size // 2 + 1
+    start = time.perf_counter()
+    for nodenum, index in updates:
+        match[nodenum] = index
+        commit_index = min(sorted(match.values(), reverse=True)[:quorum])
+    return (time.perf_counter() - start) / len(updates), commit_index
+
+
+def tracker_commit(size, updates):
+    tracker = QuorumTracker(range(1, size + 1))
+    tracker.update(1, max(index for _, index in updates))
+    start = time.perf_counter()
+    for nodenum, index in updates:
+        commit_index = tracker.update(nodenum, index)
+    return (time.perf_counter() - start) / len(updates), commit_index
+
+
+# The whole of update_last_applied on a leader, including applying
+def controller_commit(size, updates):
+    leader = RaftController(1, "LEADER", cluster=range(1, size + 1))
+    last = max(index for _, index in updates)
+    leader.log.log_entries.extend(LogEntry(0, "") for _ in range(last))
+    start = time.perf_counter()
+    for nodenum, index in updates:
+        leader.update_last_applied(nodenum, index)
+    return (time.perf_counter() - start) / len(updates), leader.commit_index
+
+
+def main(count=100000):
+    print(f"{count} responses, microseconds per response")
+    print(f"{'nodes':>6} {'sorted':>9} {'tracker':>9} {'controller':>11}")
+    for size in SIZES:
+        updates = responses(size, count)
+        slow, expected = sorted_commit(size, updates)
+        fast, commit_index = tracker_commit(size, updates)
+        full, leader_commit = controller_commit(size, updates)
+        assert commit_index == leader_commit == expected
+        print(f"{size:>6} {slow * 1e6:9.2f} {fast * 1e6:9.2f} {full * 1e6:11.2f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,116 @@
+# Memory held by the log and restart time of a node, with and without
+# automatic snapshots.  Restart time covers loading the write-ahead log
+# and getting the KVServer back to the last committed entry.  Also the
+# peak memory of streaming a large snapshot between two write-ahead logs
+# through the binary codec.
+#
+#   python bench_snapshot.py [entries] [transfer MB]
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from codec import encode, decode
+from controller import RaftController
+from kvserver import KVServer
+from log import LogEntry, RaftLog
+from message import InstallSnapshotMessage
+from wal import WriteAheadLog
+
+BATCH = 1000
+
+
+# Append and commit entries on a single-node leader
+def fill(controller, entries):
+    for start in range(0, entries, BATCH):
+        prev = controller.last_applied_index
+        batch = [LogEntry(0, f"set key{i % 1000} {i}") for i in range(start, start + BATCH)]
+        controller.log.append_entry(prev, controller.log.log_entries[prev].term, batch)
+        controller.commit_index = controller.last_applied_index
+        controller.apply_committed()
+
+
+def memory(entries, snapshot_threshold):
+    tracemalloc.start()
+    controller = RaftController(
+        1, "LEADER", state_machine=KVServer(), snapshot_threshold=snapshot_threshold
+    )
+    fill(controller, entries)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+def restart(entries, snapshot_threshold):
+    with tempfile.TemporaryDirectory() as directory:
+        wal = WriteAheadLog(directory, fsync_window=1.0)
+        controller = RaftController(
+            1,
+            "LEADER",
+            log=RaftLog(wal),
+            state_machine=KVServer(),
+            snapshot_threshold=snapshot_threshold,
+        )
+        fill(controller, entries)
+        wal.close()
+
+        start = time.perf_counter()
+        controller = RaftController(
+            1, log=RaftLog(WriteAheadLog(directory)), state_machine=KVServer()
+        )
+        controller.commit_index = controller.last_applied_index
+        controller.apply_committed()
+        return time.perf_counter() - start
+
+
+# Stream a snapshot of size bytes from one log to another a chunk at a
+# time, returning the peak memory and elapsed time
+def transfer(size, chunk_bytes=1 << 20):
+    with tempfile.TemporaryDirectory() as directory:
+        source = WriteAheadLog(os.path.join(directory, "leader"))
+        source.load()
+        writer = source.snapshot_writer(1, 1)
+        for _ in range(0, size, chunk_bytes):
+            writer.write(os.urandom(chunk_bytes))
+        source.install(writer)
+        snapshot = source.snapshot
+        dest = RaftLog(WriteAheadLog(os.path.join(directory, "follower")))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        offset = 0
+        while dest.snapshot_index != snapshot.index:
+            data = snapshot.read(offset, chunk_bytes)
+            done = offset + len(data) >= snapshot.size
+            msg = InstallSnapshotMessage(1, 1, 1, 1, offset, data, done)
+            msg = decode(encode(msg))
+            offset = dest.receive_snapshot(
+                msg.last_included_index,
+                msg.last_included_term,
+                msg.offset,
+                msg.data,
+                msg.done,
+            )
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, elapsed
+
+
+def main(entries=100000, transfer_mb=256):
+    print(f"{entries} committed entries over 1000 keys")
+    for name, threshold in [("no snapshots", None), ("snapshot every 10000", 10000)]:
+        used = memory(entries, threshold)
+        elapsed = restart(entries, threshold)
+        print(f"{name:>22}: {used / 1e6:8.1f}MB in memory  {elapsed:7.3f}s restart")
+
+    peak, elapsed = transfer(transfer_mb << 20)
+    print(
+        f"{transfer_mb}MB snapshot streamed in 1MB chunks: "
+        f"{peak / 1e6:.1f}MB peak, {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,36 @@
+# Appends/sec into a durable RaftLog for different fsync batching: the
+# number of entries handed to append_entry at once and the fsync window.
+#
+#   python bench_wal.py [entries]
+import sys
+import tempfile
+import time
+
+from log import LogEntry, RaftLog
+from wal import WriteAheadLog
+
+
+def run(entries, batch, fsync_window):
+    with tempfile.TemporaryDirectory() as directory:
+        rl = RaftLog(WriteAheadLog(directory, fsync_window=fsync_window))
+        start = time.perf_counter()
+        for i in range(0, entries, batch):
+            prev = len(rl.log_entries) - 1
+            batch_entries = [LogEntry(1, "set key value")] * batch
+            rl.append_entry(prev, rl.log_entries[prev].term, batch_entries)
+        rl.storage.close()
+        elapsed = time.perf_counter() - start
+        return entries / elapsed, rl.storage.fsyncs
+
+
+def main(entries=5000):
+    print(f"{entries} appends of one entry, or in batches")
+    print(f"{'batch':>6} {'window':>8} {'appends/s':>10} {'fsyncs':>7}")
+    for batch in (1, 16, 256):
+        for fsync_window in (0.0, 0.001, 0.01, 0.1):
+            rate, fsyncs = run(entries, batch, fsync_window)
+            print(f"{batch:6d} {fsync_window * 1000:6.0f}ms {rate:10.0f} {fsyncs:7d}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
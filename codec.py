@@ -0,0 +1,221 @@
+# Compact binary encoding for Raft messages.
+#
+# Every message starts with a version byte and a type byte, followed by
+# its fields in dataclass order.  Each message type has a layout string
+# with one code per field:
+#
+#   q   signed 64-bit int
+#   ?   bool
+#   d   float (double)
+#   s   str, utf-8 with a 4-byte length prefix
+#   b   bytes with a 4-byte length prefix
+#   n   tuple of node numbers: a 4-byte count then a signed 64-bit int each
+#   e   list[LogEntry]: a 4-byte count and the byte size of the commands,
+#       then every term, then the length of every command in characters,
+#       then all the commands as one utf-8 string
+#
+# Runs of fixed-size fields are packed with a single precompiled struct.
+# Type ids are part of the wire format: never reuse or renumber one, add
+# new message types at the end and bump VERSION when a layout changes.
+import pickle
+import struct
+
+from dataclasses import fields
+from operator import attrgetter
+
+from log import LogEntry
+from message import (
+    AppendEntriesMessage,
+    AppendEntriesResponse,
+    NewCommandMessage,
+    RequestVoteMessage,
+    RequestVoteResponse,
+    InstallSnapshotMessage,
+    InstallSnapshotResponse,
+    MembershipChangeMessage,
+    ReadMessage,
+    ClockTick,
+)
+
+VERSION = 6
+
+MESSAGES = [
+    (1, AppendEntriesMessage, "qqeqqq"),
+    (2, AppendEntriesResponse, "?qqqqqq"),
+    (3, NewCommandMessage, "s"),
+    (4, RequestVoteMessage, "qqqq"),
+    (5, RequestVoteResponse, "?qq"),
+    (6, ClockTick, "d"),
+    (7, InstallSnapshotMessage, "qqqqqb?nn"),
+    (8, InstallSnapshotResponse, "qqqq"),
+    (9, MembershipChangeMessage, "q??"),
+    (10, ReadMessage, "s"),
+]
+
+_HEADER = struct.Struct(">BB")
+_LENGTH = struct.Struct(">I")
+_ENTRIES = struct.Struct(">II")
+_NO_ENTRIES = _ENTRIES.pack(0, 0)
+_FIXED = "q?d"
+
+
+# Split a layout into steps: a precompiled struct for each run of fixed
+# fields, or the code of a variable-length field.
+def _compile(layout):
+    steps = []
+    run = ""
+    for code in layout:
+        if code in _FIXED:
+            run += code
+            continue
+        if run:
+            steps.append(struct.Struct(">" + run))
+            run = ""
+        steps.append(code)
+    if run:
+        steps.append(struct.Struct(">" + run))
+    return steps
+
+
+_ENCODERS = {}
+_DECODERS = {}
+for type_id, cls, layout in MESSAGES:
+    assert len(layout) == len(fields(cls)), cls
+    getter = attrgetter(*[field.name for field in fields(cls)])
+    if len(layout) == 1:
+        getter = (lambda get: lambda msg: (get(msg),))(getter)
+    _ENCODERS[cls] = (type_id, getter, _compile(layout))
+    _DECODERS[type_id] = (cls, _compile(layout))
+
+
+def _encode_str(value):
+    return _encode_bytes(value.encode("utf-8"))
+
+
+def _encode_bytes(data):
+    return _LENGTH.pack(len(data)) + data
+
+
+def _encode_nodes(nodes):
+    return _LENGTH.pack(len(nodes)) + struct.pack(f">{len(nodes)}q", *nodes)
+
+
+def _encode_entries(entries):
+    count = len(entries)
+    if not count:
+        return _NO_ENTRIES
+    commands = "".join([entry.command for entry in entries]).encode("utf-8")
+    return b"".join(
+        [
+            _ENTRIES.pack(count, len(commands)),
+            struct.pack(f">{count}q", *[entry.term for entry in entries]),
+            struct.pack(f">{count}I", *[len(entry.command) for entry in entries]),
+            commands,
+        ]
+    )
+
+
+def encode(msg) -> bytes:
+    try:
+        type_id, getter, steps = _ENCODERS[type(msg)]
+    except KeyError:
+        raise TypeError(f"Can't encode {type(msg).__name__}") from None
+
+    values = getter(msg)
+    chunks = [_HEADER.pack(VERSION, type_id)]
+    pos = 0
+    for step in steps:
+        if step == "s":
+            chunks.append(_encode_str(values[pos]))
+            pos += 1
+        elif step == "b":
+            chunks.append(_encode_bytes(values[pos]))
+            pos += 1
+        elif step == "e":
+            chunks.append(_encode_entries(values[pos]))
+            pos += 1
+        elif step == "n":
+            chunks.append(_encode_nodes(values[pos]))
+            pos += 1
+        else:
+            end = pos + len(step.format) - 1
+            chunks.append(step.pack(*values[pos:end]))
+            pos = end
+    return b"".join(chunks)
+
+
+def _decode_str(data, offset):
+    value, offset = _decode_bytes(data, offset)
+    return value.decode("utf-8"), offset
+
+
+def _decode_bytes(data, offset):
+    (size,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    return bytes(data[offset : offset + size]), offset + size
+
+
+def _decode_nodes(data, offset):
+    (count,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    nodes = struct.unpack_from(f">{count}q", data, offset)
+    return nodes, offset + 8 * count
+
+
+def _decode_entries(data, offset):
+    count, size = _ENTRIES.unpack_from(data, offset)
+    offset += _ENTRIES.size
+    if not count:
+        return [], offset
+    terms = struct.unpack_from(f">{count}q", data, offset)
+    offset += 8 * count
+    lengths = struct.unpack_from(f">{count}I", data, offset)
+    offset += 4 * count
+    commands = data[offset : offset + size].decode("utf-8")
+
+    entries = []
+    start = 0
+    for term, length in zip(terms, lengths):
+        end = start + length
+        entries.append(LogEntry(term, commands[start:end]))
+        start = end
+    return entries, offset + size
+
+
+def decode(data: bytes):
+    version, type_id = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported codec version {version}")
+    try:
+        cls, steps = _DECODERS[type_id]
+    except KeyError:
+        raise ValueError(f"Unknown message type {type_id}") from None
+
+    values = []
+    offset = _HEADER.size
+    for step in steps:
+        if step == "s":
+            value, offset = _decode_str(data, offset)
+            values.append(value)
+        elif step == "b":
+            value, offset = _decode_bytes(data, offset)
+            values.append(value)
+        elif step == "e":
+            value, offset = _decode_entries(data, offset)
+            values.append(value)
+        elif step == "n":
+            value, offset = _decode_nodes(data, offset)
+            values.append(value)
+        else:
+            values.extend(step.unpack_from(data, offset))
+            offset += step.size
+    if offset != len(data):
+        raise ValueError("Trailing bytes after message")
+    return cls(*values)
+
+
+# Codecs a node can be configured with, as (dumps, loads) pairs
+CODECS = {
+    "pickle": (pickle.dumps, pickle.loads),
+    "binary": (encode, decode),
+}
@@ -1,12 +1,14 @@
-import pickle
+import sys
 
-from controller import NewCommandMessage
+from codec import CODECS
+from message import NewCommandMessage, MembershipChangeMessage, ReadMessage
 
 from net import RaftNet
 
 
-def console():
+def console(codec="pickle"):
     net = RaftNet()
+    dumps, _ = CODECS[codec]
 
     while True:
         cmd = input(f"> ")
@@ -15,10 +17,16 @@ def console():
         cmd = message.pop(0)
         if cmd == "command":
             message = NewCommandMessage(" ".join(message))
+        elif cmd == "read":
+            message = ReadMessage(" ".join(message))
+        elif cmd in ("add", "remove", "learner"):
+            message = MembershipChangeMessage(
+                int(message[0]), cmd != "remove", cmd == "learner"
+            )
         else:
             print("invalid command")
-        print(net.send(int(dest), pickle.dumps(message)))
+        print(net.send(int(dest), dumps(message)))
 
 
 if __name__ == "__main__":
-    console()
+    console(*sys.argv[1:])
@@ -1,5 +1,9 @@
 import queue
 import random
+import time
+
+from concurrent.futures import Future
+from dataclasses import dataclass
 
 from message import (
     AppendEntriesMessage,
@@ -7,16 +11,81 @@ from message import (
     NewCommandMessage,
     RequestVoteMessage,
     RequestVoteResponse,
+    InstallSnapshotMessage,
+    InstallSnapshotResponse,
+    MembershipChangeMessage,
+    ReadMessage,
     ClockTick,
 )
-from log import RaftLog, LogEntry
+from log import RaftLog, LogEntry, Snapshot, CONFIG_PREFIX, config_command, parse_config
+from quorum import QuorumTracker
+
+
+# Rough wire size of a LogEntry beyond its command, for batch byte caps
+ENTRY_OVERHEAD = 16
+
+NOT_LEADER = b"command sent to node that is not leader"
+
+# Shortest time in milliseconds a follower waits to hear from a leader
+# before standing for election.  Each wait is this plus up to a second.
+MIN_ELECTION_TIMEOUT = 500.0
+
+
+@dataclass
+class ClientRead:
+    # A ReadMessage on its way through the controller, with the future
+    # its answer is delivered to
+    command: str
+    future: Future
 
 
 class RaftController:
-    def __init__(self, nodenum: int, role="FOLLOWER"):
+    def __init__(
+        self,
+        nodenum: int,
+        role="FOLLOWER",
+        max_batch_entries=1024,
+        max_batch_bytes=1 << 20,
+        initial_batch_entries=64,
+        log=None,
+        state_machine=None,
+        snapshot_threshold=None,
+        snapshot_chunk_bytes=1 << 20,
+        proposal_batch=1,
+        proposal_window=0.0,
+        cluster=(1, 2, 3, 4, 5),
+        lease_reads=False,
+        max_clock_drift=0.1,
+    ):
         self.nodenum = nodenum
-        self.log = RaftLog()
+        self.log = log if log is not None else RaftLog()
+
+        # Cluster configurations as (index, voting nodes, learners),
+        # oldest first.  The first is the configuration as of the
+        # snapshot, or cluster if there isn't one, and the rest come from
+        # config entries in the log.  A node uses the latest one,
+        # committed or not.
+        snapshot = self.log.snapshot
+        if snapshot is not None and snapshot.config:
+            base = (snapshot.config, snapshot.learners)
+        else:
+            base = (tuple(sorted(cluster)), ())
+        self._configs = [(self.log.snapshot_index, *base)]
         self.commit_index = 0
+
+        # Committed entries are applied to the state machine (anything
+        # with apply/dump/load, such as KVServer) up to applied_index.
+        # Once snapshot_threshold entries have been applied since the
+        # last snapshot the log is compacted into a new one, which is
+        # sent to followers that need it snapshot_chunk_bytes at a time.
+        self.state_machine = state_machine
+        self.snapshot_threshold = snapshot_threshold
+        self.snapshot_chunk_bytes = snapshot_chunk_bytes
+        self.applied_index = self.log.snapshot_index
+        if self.log.snapshot is not None:
+            self.commit_index = self.log.snapshot_index
+            if state_machine is not None:
+                state_machine.load(self.log.snapshot.data)
         self.outgoing_messages = queue.Queue()
         self.incoming_messages = queue.Queue()
 
@@ -27,30 +96,98 @@ class RaftController:
 
         self.candidate_id = None
 
-        self._last_applied_indexes = {
-            1: 0,
-            2: 0,
-            3: 0,
-            4: 0,
-            5: 0,
-        }
-
-        self.votes = {
-            1: None,
-            2: None,
-            3: None,
-            4: None,
-            5: None,
-        }
+        self.match_index = QuorumTracker(self.cluster)
+
+        # Nodes that have voted for us in this term
+        self.votes = set()
+
+        # How much of our log each learner has.  Learners don't count
+        # towards the commit index, but this tells us when one has
+        # caught up enough to be promoted.
+        self.learner_index = dict.fromkeys(self._configs[0][2], 0)
+
+        # Leader state for replication.  match_index above is how much
+        # of our log each node in the cluster has, from which the commit
+        # index follows; next_index is where a follower's next batch
+        # starts.  Batch sizes adapt to how quickly it answers.
+        self.next_index = {}
+        self.max_batch_entries = max_batch_entries
+        self.max_batch_bytes = max_batch_bytes
+        self.initial_batch_entries = min(initial_batch_entries, max_batch_entries)
+        self._batch_sizes = {}
+        self._in_flight = set()
+        self._snapshot_offsets = {}
+
+        # New commands on a leader are collected and appended and
+        # replicated together, up to proposal_batch commands or
+        # max_batch_bytes at a time.  They wait at most proposal_window
+        # seconds for the batch to fill, or with no window until nothing
+        # else is queued.  proposal_batch=1 sends each command alone.
+        self.proposal_batch = proposal_batch
+        self.proposal_window = proposal_window
+        self._proposals = []
+        self._proposal_bytes = 0
+        self._proposal_started = 0.0
+
+        # ReadIndex reads.  The leader notes its commit index, checks it
+        # is still leader with one round of heartbeats and answers once
+        # that index has been applied.  Only one round is in flight at a
+        # time and reads that arrive meanwhile share the next one.
+        # read_seq numbers the rounds; AppendEntries carry it and the
+        # responses echo it back.
+        self.read_seq = 0
+        self._pending_reads = []
+        self._read_round = None
+        self._read_acks = set()
+        self._ready_reads = []
+
+        # With lease_reads a leader answers reads straight away while it
+        # holds a lease: for a while after a quorum confirmed it as
+        # leader, no other node can have been elected.  That relies on
+        # nodes not voting for anyone else until MIN_ELECTION_TIMEOUT
+        # after hearing from a leader, so every node in the cluster
+        # must have it set.  The lease is cut short by max_clock_drift,
+        # the most that clock rates can differ by, as a fraction.  Time
+        # is the milliseconds counted by ClockTicks.
+        self.lease_reads = lease_reads
+        self.max_clock_drift = max_clock_drift
+        self.clock = 0.0
+        self._tick = 0.0
+        self._lease_start = None
+        self._leader_contact = None
 
         if role == True:
             role = "LEADER"
         self.role = role
+        self._track_configs(self.log.snapshot_index + 1)
+        self._update_role()
 
     @property
     def leader(self):
         return self.role == "LEADER"
 
+    # The voting nodes in the latest configuration
+    @property
+    def cluster(self):
+        return self._configs[-1][1]
+
+    # The non-voting nodes in the latest configuration
+    @property
+    def learners(self):
+        return self._configs[-1][2]
+
+    # The nodes we exchange messages with: those in any configuration
+    # since the snapshot, so a leader that is removing itself still
+    # hears from the others, and removed nodes hear that they are out
+    @property
+    def peers(self):
+        return self._peers
+
+    # The latest configuration that has been committed
+    @property
+    def committed_cluster(self):
+        return self._config_at(self.commit_index)[0]
+
     @property
     def last_applied(self):
         return len(self.log.log_entries) - 1
@@ -64,7 +201,17 @@ class RaftController:
         return self.log.log_entries[self.last_applied_term].term
 
     def reset_timeout(self):
-        self.timeout = (random.random() * 1000) + 500
+        self.timeout = (random.random() * 1000) + MIN_ELECTION_TIMEOUT
+
+    # Whether we hold a lease to answer reads without confirming we're
+    # still leader.  The clock only moves on ticks so it can be a tick
+    # behind, which comes off the lease as well.
+    @property
+    def lease_valid(self):
+        if not self.leader or self._lease_start is None:
+            return False
+        lease = MIN_ELECTION_TIMEOUT * (1 - self.max_clock_drift) - self._tick
+        return self.clock < self._lease_start + lease
 
     def handle_message(self, msg):
         if isinstance(msg, AppendEntriesMessage):
@@ -75,6 +222,14 @@ class RaftController:
             return self._handle_request_vote_message(msg)
         elif isinstance(msg, RequestVoteResponse):
             return self._handle_request_vote_response(msg)
+        elif isinstance(msg, InstallSnapshotMessage):
+            return self._handle_install_snapshot(msg)
+        elif isinstance(msg, InstallSnapshotResponse):
+            return self._handle_install_snapshot_response(msg)
+        elif isinstance(msg, MembershipChangeMessage):
+            return self._handle_membership_change(msg)
+        elif isinstance(msg, ClientRead):
+            return self._handle_read(msg)
         elif isinstance(msg, ClockTick):
             self._handle_clock_tick(msg)
 
@@ -90,17 +245,33 @@ class RaftController:
 
         self.term = msg.term
         self.reset_timeout()
+        self._leader_contact = self.clock
 
-        # TODO: if fail return AppendEntriesResp with idx that needs resolving
         success = self.log.append_entry(
             msg.prev_log_idx, msg.prev_log_term, msg.entries
         )
+        if success and msg.entries:
+            self._track_configs(max(msg.prev_log_idx, self.log.snapshot_index) + 1)
+
+        # Tell the leader where we diverge so it can skip a whole term
+        conflict_term, conflict_index = -1, -1
+        if not success:
+            conflict_term, conflict_index = self.log.conflict_hint(msg.prev_log_idx)
 
         # commit_index for a follower is the min of last_applied and the leader commit index
-        self.commit_index = min(msg.leader_commit_index, self.last_applied)
+        self.commit_index = max(
+            self.commit_index, min(msg.leader_commit_index, self.last_applied)
+        )
+        self.apply_committed()
 
         resp = AppendEntriesResponse(
-            success, self.last_applied, self.term, self.nodenum
+            success,
+            self.last_applied,
+            self.term,
+            self.nodenum,
+            conflict_term,
+            conflict_index,
+            msg.read_seq,
         )
         self.send(resp)
 
@@ -112,49 +283,406 @@ class RaftController:
             self.become_follower()
             return
 
-        self.update_last_applied(msg.nodenum, msg.last_applied_index)
+        nodenum = msg.nodenum
+        self._in_flight.discard(nodenum)
+        if self._read_round is not None and msg.term == self.term:
+            self._ack_read_round(nodenum, msg.read_seq)
+        if msg.success:
+            self._snapshot_offsets.pop(nodenum, None)
+            self.update_last_applied(nodenum, msg.last_applied_index)
+            # A late answer to an earlier batch mustn't move us back
+            self.next_index[nodenum] = max(
+                self.next_index.get(nodenum, 0), msg.last_applied_index + 1
+            )
+            # The follower keeps up, so let it have bigger batches
+            self._batch_sizes[nodenum] = min(
+                self.batch_size(nodenum) * 2, self.max_batch_entries
+            )
+        else:
+            # Always back up at least one entry, further if the hint allows
+            self.next_index[nodenum] = max(
+                1, min(self.get_next_index(nodenum) - 1, self._next_from_hint(msg))
+            )
 
-        if msg.last_applied_index == self.last_applied:
-            return
+        if self.get_next_index(nodenum) <= self.last_applied_index:
+            self.replicate(nodenum)
 
-        if (
-            self.leader
-            and msg.success
-            and msg.last_applied_index < self.last_applied_index
-        ):
-            # send append and index + 1
-            resp = AppendEntriesMessage(
-                msg.last_applied_index,
-                self.log.log_entries[msg.last_applied_index].term,
-                [self.log.log_entries[msg.last_applied_index + 1]],
+        return True
+
+    def _next_from_hint(self, msg: AppendEntriesResponse):
+        if msg.conflict_index < 0:
+            # No hint, so jump to the end of the follower's log
+            return msg.last_applied_index + 1
+        if msg.conflict_term < 0:
+            return msg.conflict_index
+        # Resume after our own last entry of the conflicting term, or
+        # skip that whole term if we don't have it
+        last = self.log.last_index_of_term(msg.conflict_term)
+        if last is not None:
+            return last + 1
+        return msg.conflict_index
+
+    def get_next_index(self, nodenum):
+        # Until a follower answers, assume it is up to date with us
+        return self.next_index.get(nodenum, self.last_applied_index + 1)
+
+    def batch_size(self, nodenum):
+        return self._batch_sizes.get(nodenum, self.initial_batch_entries)
+
+    # Send a follower the next batch of entries from its next_index, or
+    # our snapshot if those entries have been compacted away.  next_index
+    # moves past the batch straight away, so answers to batches already
+    # in flight don't send it again.  If it is lost the follower rejects
+    # the next heartbeat and next_index backs up.
+    def replicate(self, nodenum):
+        prev_idx = self.get_next_index(nodenum) - 1
+        if prev_idx < self.log.snapshot_index:
+            self.send_snapshot(nodenum)
+            self._in_flight.add(nodenum)
+            return
+        entries = self._batch(prev_idx + 1, self.batch_size(nodenum))
+        self.send(
+            AppendEntriesMessage(
+                prev_idx,
+                self.log.log_entries[prev_idx].term,
+                entries,
                 self.commit_index,
                 self.term,
+                self.read_seq,
+            )
+        )
+        self.next_index[nodenum] = prev_idx + 1 + len(entries)
+        self._in_flight.add(nodenum)
+
+    # Send a follower the next chunk of our snapshot, carrying on from
+    # however much it last told us it had.  Only one chunk is read into
+    # memory at a time.
+    def send_snapshot(self, nodenum):
+        snapshot = self.log.snapshot
+        offset = min(self._snapshot_offsets.get(nodenum, 0), snapshot.size)
+        data = snapshot.read(offset, self.snapshot_chunk_bytes)
+        self.send(
+            InstallSnapshotMessage(
+                self.term,
+                self.nodenum,
+                snapshot.index,
+                snapshot.term,
+                offset,
+                data,
+                offset + len(data) >= snapshot.size,
+                snapshot.config,
+                snapshot.learners,
+            )
+        )
+
+    def _handle_install_snapshot(self, msg: InstallSnapshotMessage):
+        if msg.term < self.term:
+            self.send(
+                AppendEntriesResponse(False, self.last_applied, self.term, self.nodenum)
+            )
+            return
+
+        if msg.term > self.term:
+            self.become_follower()
+
+        self.term = msg.term
+        self.reset_timeout()
+        self._leader_contact = self.clock
+
+        # Ignore a snapshot that is older than what we've already applied
+        if msg.last_included_index > self.applied_index:
+            received = self.log.receive_snapshot(
+                msg.last_included_index,
+                msg.last_included_term,
+                msg.offset,
+                msg.data,
+                msg.done,
+                msg.config,
+                msg.learners,
             )
+            if self.log.snapshot_index != msg.last_included_index:
+                # Not installed yet, so ask for what comes next.  After
+                # a lost chunk this is where the leader resumes from.
+                self.send(
+                    InstallSnapshotResponse(
+                        self.term, self.nodenum, msg.last_included_index, received
+                    )
+                )
+                return
+            if self.state_machine is not None:
+                self.state_machine.load(self.log.snapshot.data)
+            self.applied_index = msg.last_included_index
+            self._reset_configs()
+            self.commit_index = max(self.commit_index, msg.last_included_index)
 
-            self.send(resp)
+        # Let the leader carry on replicating from the end of our log
+        self.send(
+            AppendEntriesResponse(True, self.last_applied, self.term, self.nodenum)
+        )
+
+    def _handle_install_snapshot_response(self, msg: InstallSnapshotResponse):
+        if not self.leader:
+            return
+
+        if msg.term > self.term:
+            self.become_follower()
+            return
+
+        # A follower still on an older snapshot of ours starts over
+        nodenum = msg.nodenum
+        self._in_flight.discard(nodenum)
+        if msg.last_included_index == self.log.snapshot_index:
+            self._snapshot_offsets[nodenum] = msg.offset
+        else:
+            self._snapshot_offsets[nodenum] = 0
+        self.replicate(nodenum)
+
+    # Apply newly committed entries to the state machine, then snapshot
+    # if enough of the log has been applied since the last one
+    def apply_committed(self):
+        if self.state_machine is None or self.applied_index >= self.commit_index:
+            return
+
+        entries = self.log.log_entries[self.applied_index + 1 : self.commit_index + 1]
+        for entry in entries:
+            if entry.command and not entry.command.startswith(CONFIG_PREFIX):
+                self.state_machine.apply(entry.command)
+        self.applied_index = self.commit_index
+        if self._ready_reads:
+            self._serve_reads()
 
         if (
-            self.leader
-            and not msg.success
-            and msg.last_applied_index < len(self.log.log_entries) - 1
+            self.snapshot_threshold is not None
+            and self.applied_index - self.log.snapshot_index >= self.snapshot_threshold
         ):
-            # send append and index + 1
-            prev_idx = msg.last_applied_index
-            logs = ([self.log.log_entries[prev_idx + 1]],)
-            resp = AppendEntriesMessage(
-                prev_idx - 1,
-                self.log.log_entries[prev_idx - 1].term,
-                # self.log.log_entries[prev_idx+1:],
-                self.log.log_entries[prev_idx + 1 :],
-                # len(self.log.log_entries),
-                self.commit_index,
-                self.term,
-            )
-            self.send(resp)
+            self.take_snapshot()
+
+    # Compact the log up to applied_index into a snapshot of the state
+    # machine, which holds exactly the entries up to there
+    def take_snapshot(self):
+        index = self.applied_index
+        term = self.log.log_entries[index].term
+        config, learners = self._config_at(index)
+        self.log.compact(
+            Snapshot(index, term, self.state_machine.dump(), config, learners)
+        )
+        self._reset_configs()
+
+    # Membership changes go through the log one node at a time: any two
+    # majorities of configurations that differ by one node overlap, so
+    # there is no need for joint consensus.  A node uses a configuration
+    # as soon as it is in its log, and a new one can't be proposed until
+    # the last has committed.  The leader must also have committed an
+    # entry of its own term, so that an uncommitted change from an
+    # earlier leader can't still be in play.
+    #
+    # Learners don't vote, so adding one doesn't change any majority.
+    # A new node can join as a learner, copy the log or snapshot
+    # without holding up commits, and be promoted once it has every
+    # committed entry.
+    def _handle_membership_change(self, msg: MembershipChangeMessage):
+        if not self.leader:
+            return False
+        if self._configs[-1][0] > self.commit_index:
+            return False
+        if self.log.log_entries[self.commit_index].term != self.term:
+            return False
 
-        return True
+        nodenum = msg.nodenum
+        nodes = set(self.cluster)
+        learners = set(self.learners)
+        if not msg.add:
+            nodes.discard(nodenum)
+            learners.discard(nodenum)
+        elif msg.learner:
+            if nodenum not in nodes:
+                learners.add(nodenum)
+        elif nodenum in learners:
+            if self.learner_index.get(nodenum, 0) < self.commit_index:
+                return False
+            learners.discard(nodenum)
+            nodes.add(nodenum)
+        else:
+            nodes.add(nodenum)
+        if (nodes, learners) == (set(self.cluster), set(self.learners)) or not nodes:
+            return False
+
+        # Commands collected before the change go first
+        self.flush_proposals()
+        self._proposals = [LogEntry(self.term, config_command(nodes, learners))]
+        return self.flush_proposals()
+
+    # Pick up configuration entries from start to the end of our log,
+    # dropping any later configurations that were truncated away
+    def _track_configs(self, start):
+        while len(self._configs) > 1 and self._configs[-1][0] >= start:
+            self._configs.pop()
+        current = self._configs[-1][1:]
+        entries = self.log.log_entries
+        for index in range(start, len(entries)):
+            config = parse_config(entries[index].command)
+            if config is not None:
+                self._configs.append((index, *config))
+        self._peers = tuple(
+            sorted(
+                {
+                    nodenum
+                    for _, nodes, learners in self._configs
+                    for nodenum in nodes + learners
+                }
+                - {self.nodenum}
+            )
+        )
+        if self._configs[-1][1:] != current:
+            self._reconfigure()
+
+    # After a snapshot the configuration as of it is the new first one
+    def _reset_configs(self):
+        current = self._configs[-1][1:]
+        index = self.log.snapshot_index
+        snapshot = self.log.snapshot
+        if snapshot.config:
+            config = (tuple(snapshot.config), tuple(snapshot.learners))
+        else:
+            config = self._config_at(index)
+        self._configs = [(index, *config)]
+        self._track_configs(index + 1)
+        if self._configs[-1][1:] != current:
+            self._reconfigure()
+
+    # The voting nodes and learners as of index
+    def _config_at(self, index):
+        for i, nodes, learners in reversed(self._configs):
+            if i <= index:
+                return nodes, learners
+        return self._configs[0][1:]
+
+    # Count matches and votes among the new voting nodes, keeping what
+    # we already know about the ones that stay or were learners
+    def _reconfigure(self):
+        match_index = QuorumTracker(self.cluster)
+        for nodenum in self.cluster:
+            if nodenum in self.match_index:
+                match_index.update(nodenum, self.match_index[nodenum])
+            elif nodenum in self.learner_index:
+                match_index.update(nodenum, self.learner_index[nodenum])
+        self.match_index = match_index
+        self.learner_index = {
+            nodenum: self.learner_index.get(nodenum, 0) for nodenum in self.learners
+        }
+        self.votes &= set(self.cluster)
+        self._update_role()
+
+    # Learners follow the leader but never vote or stand for election
+    def _update_role(self):
+        if self.role == "FOLLOWER" and self.nodenum in self.learners:
+            self.role = "LEARNER"
+        elif self.role == "LEARNER" and self.nodenum not in self.learners:
+            self.role = "FOLLOWER"
+
+    def _handle_read(self, msg: ClientRead):
+        if not self.leader or self.state_machine is None:
+            msg.future.set_result(NOT_LEADER)
+            return msg.future
+        if (
+            self.lease_valid
+            and self.log.log_entries[self.commit_index].term == self.term
+        ):
+            msg.future.set_result(self.state_machine.query(msg.command))
+            return msg.future
+        self._pending_reads.append(msg)
+        if self._read_round is None:
+            self._start_read_round()
+        return msg.future
+
+    # Confirm we are still leader for the reads waiting, or with
+    # lease_reads to renew the lease.  Their read index is our commit
+    # index, which is only known to be up to date once an entry of our
+    # own term has committed.
+    def _start_read_round(self):
+        if not self._pending_reads and not self.lease_reads:
+            return
+        if self.log.log_entries[self.commit_index].term != self.term:
+            return
+        self.read_seq += 1
+        self._read_round = (
+            self.read_seq,
+            self.commit_index,
+            self._pending_reads,
+            self.clock,
+        )
+        self._pending_reads = []
+        self._read_acks = set()
+        self.send_heartbeat()
+        self._ack_read_round(self.nodenum, self.read_seq)
+
+    # A voting node has answered an AppendEntries from round seq or later
+    def _ack_read_round(self, nodenum, seq):
+        round_seq, read_index, reads, started = self._read_round
+        if seq < round_seq or nodenum not in self.match_index:
+            return
+        self._read_acks.add(nodenum)
+        if len(self._read_acks) < self.match_index.quorum:
+            return
+        self._read_round = None
+        self._lease_start = started
+        if reads:
+            self._ready_reads.append((read_index, reads))
+            self._serve_reads()
+            self._start_read_round()
+
+    # Answer the confirmed reads whose read index has been applied
+    def _serve_reads(self):
+        while self._ready_reads and self._ready_reads[0][0] <= self.applied_index:
+            _, reads = self._ready_reads.pop(0)
+            for read in reads:
+                read.future.set_result(self.state_machine.query(read.command))
+
+    # A leader that steps down can't answer its reads
+    def _drop_reads(self):
+        reads = self._pending_reads
+        if self._read_round is not None:
+            reads += self._read_round[2]
+        for _, ready in self._ready_reads:
+            reads += ready
+        for read in reads:
+            read.future.set_result(NOT_LEADER)
+        self._pending_reads = []
+        self._read_round = None
+        self._ready_reads = []
+        self._lease_start = None
+
+    # Up to limit entries from start, capped at max_batch_bytes but
+    # always at least one entry so a large command can't stall a follower
+    def _batch(self, start, limit):
+        entries = []
+        size = 0
+        for entry in self.log.log_entries[start : start + limit]:
+            size += len(entry.command) + ENTRY_OVERHEAD
+            if entries and size > self.max_batch_bytes:
+                break
+            entries.append(entry)
+        return entries
+
+    # A follower that hasn't answered its last batch by the next tick is
+    # falling behind, so halve what we send it
+    def _shrink_slow_batches(self):
+        for nodenum in self._in_flight:
+            self._batch_sizes[nodenum] = max(1, self.batch_size(nodenum) // 2)
+        self._in_flight.clear()
 
     def _handle_request_vote_message(self, msg: RequestVoteMessage):
+        # A node that has been removed from the cluster may not know it,
+        # so don't let it disrupt us.  Only voting nodes answer.
+        if msg.candidate_id not in self.cluster or self.nodenum not in self.cluster:
+            return
+        # Leases need us to stick with a leader we've heard from lately
+        if self.lease_reads and (
+            self.leader
+            or self._leader_contact is not None
+            and self.clock - self._leader_contact < MIN_ELECTION_TIMEOUT
+        ):
+            return
         # reply false in term
         try:
             vote_granted = True
@@ -181,28 +709,51 @@ class RaftController:
                 self.become_follower()
                 return
             elif self.role == "CANDIDATE" and msg.term == self.term:
-                self.votes[msg.nodenum] = True
-            if (
-                len([vote for vote in self.votes.values() if vote]) >= 3
-                and self.role != "LEADER"
-            ):
-                self.become_leader()
-                self.send_heartbeat()
+                if msg.nodenum in self.cluster:
+                    self.votes.add(msg.nodenum)
+            self._check_election()
         except Exception as e:
             print(self.votes)
 
+    # Become leader once a majority of the current configuration has
+    # voted for us.  A new leader starts its term with an empty entry,
+    # which tells followers about it and lets it know its commit index
+    # is current once it commits.
+    def _check_election(self):
+        if self.role == "CANDIDATE" and len(self.votes) >= len(self.cluster) // 2 + 1:
+            self.become_leader()
+            self._proposals = [LogEntry(self.term, "")]
+            self.flush_proposals()
+
     def send_heartbeat(self):
         self.send(
             AppendEntriesMessage(
-                self.prev_log_idx, self.prev_log_term, [], self.commit_index, self.term
+                self.prev_log_idx,
+                self.prev_log_term,
+                [],
+                self.commit_index,
+                self.term,
+                self.read_seq,
             )
         )
 
     def _handle_clock_tick(self, msg: ClockTick):
+        self.clock += msg.milliseconds
+        self._tick = msg.milliseconds
         if self.role == "LEADER":
-            self.send_heartbeat()
+            self._shrink_slow_batches()
+            seq = self.read_seq
+            if self.lease_reads and self._read_round is None:
+                # Renew the lease, which sends the heartbeat
+                self._start_read_round()
+            if self.read_seq == seq:
+                self.send_heartbeat()
             return
         self.timeout -= msg.milliseconds
+        if self.nodenum not in self.cluster:
+            # Not a voting member, so wait to hear from a leader
+            self.reset_timeout()
+            return
         if self.role != "LEADER" and self.timeout < 0:
             print(f"Node: {self.nodenum} timed out. Becoming candidate")
             self.become_candidate()
@@ -211,25 +762,61 @@ class RaftController:
     def _handle_add_new_command(self, msg: NewCommandMessage):
         if self.role != "LEADER":
             return False
-        entry = LogEntry(term=self.term, command=msg.command)
-        success = self.append_entry(entry)
-        print(f"{self.nodenum}: {self.log.log_entries}")
+        if msg.command.startswith(CONFIG_PREFIX):
+            return False
+        if not self._proposals:
+            self._proposal_started = time.monotonic()
+        self._proposals.append(LogEntry(term=self.term, command=msg.command))
+        self._proposal_bytes += len(msg.command) + ENTRY_OVERHEAD
+        if (
+            len(self._proposals) >= self.proposal_batch
+            or self._proposal_bytes >= self.max_batch_bytes
+        ):
+            return self.flush_proposals()
+        return True
+
+    # Append the collected commands and replicate them as one batch.
+    # Commands collected by a leader that has since stepped down are
+    # dropped, as they would be overwritten by the new leader anyway.
+    def flush_proposals(self):
+        entries = self._proposals
+        self._proposals = []
+        self._proposal_bytes = 0
+        if not entries or not self.leader:
+            return False
+
+        prev_idx = self.prev_log_idx
+        prev_term = self.prev_log_term
+        success = self.log.append_entry(prev_idx, prev_term, entries)
         if success:
-            # 0 indexed but also we just added to the log.
-            prev_idx = len(self.log.log_entries) - 2
-            prev_term = self.log.log_entries[prev_idx].term
+            self._track_configs(prev_idx + 1)
+            if self.match_index.quorum == 1:
+                # Nobody else to wait for
+                self.update_last_applied(self.nodenum, self.last_applied)
+            # Followers that were up to date will be again once this lands
+            for nodenum, next_index in self.next_index.items():
+                if next_index == prev_idx + 1:
+                    self.next_index[nodenum] = self.last_applied_index + 1
             self.send(
                 AppendEntriesMessage(
                     prev_idx,
                     prev_term,
-                    [entry],
-                    # TODO: make this leader commit
-                    len(self.log.log_entries) - 1,
+                    entries,
+                    self.commit_index,
                     self.term,
+                    self.read_seq,
                 )
             )
         return success
 
+    # Seconds until the collected commands are due to be sent, or None
+    # if there aren't any
+    def proposal_delay(self):
+        if not self._proposals:
+            return None
+        due = self._proposal_started + self.proposal_window
+        return max(0.0, due - time.monotonic())
+
     def append_entry(self, msg: LogEntry):
         # TODO: handling term/current term
         # msg.term
@@ -247,22 +834,34 @@ class RaftController:
 
     @property
     def last_applied_indexes(self):
-        result = self._last_applied_indexes
-        result[self.nodenum] = self.last_applied
-        return result
+        if self.nodenum in self.match_index:
+            self.match_index.update(self.nodenum, self.last_applied)
+        return self.match_index.as_dict()
 
     def update_last_applied(self, nodenum, n):
-        self._last_applied_indexes[nodenum] = n
+        if nodenum in self.learner_index:
+            self.learner_index[nodenum] = max(self.learner_index[nodenum], n)
+            return
+        if nodenum not in self.match_index:
+            return
+        # A leader removing itself manages the cluster without being
+        # counted in it
+        if self.nodenum in self.match_index:
+            self.match_index.update(self.nodenum, self.last_applied)
+        commit_index = self.match_index.update(nodenum, n)
 
-        try:
-            # You cannot change the commit index unless the log matches the current term
-            commit_index = min(
-                sorted(self.last_applied_indexes.values(), reverse=True)[:3]
-            )
-            if self.log.log_entries[commit_index].term == self.term:
-                self.commit_index = commit_index
-        except Exception as e:
-            print(e)
+        # You cannot change the commit index unless the log matches the current term
+        if (
+            commit_index > self.commit_index
+            and self.log.log_entries[commit_index].term == self.term
+        ):
+            self.commit_index = commit_index
+            self.apply_committed()
+            if self._pending_reads and self._read_round is None:
+                self._start_read_round()
+            # Once its removal has committed a leader's job is done
+            if self.nodenum not in self.committed_cluster:
+                self.become_follower()
 
     def send(self, msg):
         return self.queue_outgoing_message(msg)
@@ -270,16 +869,33 @@ class RaftController:
     def receive(self, msg):
         return self.queue_incoming_message(msg)
 
+    # Handle the next incoming message, waiting for one if need be.
+    # Collected commands are sent once they have waited proposal_window,
+    # or when the queue runs dry if there is no window.
     def handle_incoming(self):
-        msg = self.incoming_messages.get()
+        delay = self.proposal_delay()
+        if delay == 0 and self.proposal_window:
+            self.flush_proposals()
+            delay = None
+        try:
+            msg = self.incoming_messages.get(timeout=delay)
+        except queue.Empty:
+            self.flush_proposals()
+            return None
         return self.handle_message(msg)
 
     def handle_outgoing(self):
         return self.outgoing_messages.get()
 
+    # Reads are answered later, so for a ReadMessage this returns a
+    # Future that the answer is set on
     def queue_incoming_message(self, msg):
-        if isinstance(msg, NewCommandMessage) and self.role != "LEADER":
-            return b"command sent to node that is not leader"
+        if isinstance(msg, (NewCommandMessage, ReadMessage)) and not self.leader:
+            return NOT_LEADER
+        if isinstance(msg, ReadMessage):
+            msg = ClientRead(msg.command, Future())
+            self.incoming_messages.put(msg)
+            return msg.future
         self.incoming_messages.put(msg)
         return True
 
@@ -289,20 +905,19 @@ class RaftController:
 
     def become_leader(self):
         self.role = "LEADER"
+        self.match_index = QuorumTracker(self.cluster)
+        self.learner_index = dict.fromkeys(self.learners, 0)
+        self.next_index = {}
+        self._batch_sizes = {}
+        self._in_flight = set()
+        self._snapshot_offsets = {}
         print(f"Node: {self.nodenum} becoming leader.")
 
     def become_candidate(self):
         self.role = "CANDIDATE"
         self.term += 1
         self.candidate_id = self.nodenum
-        self.votes = {
-            1: None,
-            2: None,
-            3: None,
-            4: None,
-            5: None,
-        }
-        self.votes[self.nodenum] = True
+        self.votes = {self.nodenum}
 
         try:
             msg = RequestVoteMessage(
@@ -314,18 +929,16 @@ class RaftController:
         except Exception as e:
             print(e)
         self.send(msg)
+        # A cluster of one elects itself
+        self._check_election()
 
     def become_follower(self):
+        self._drop_reads()
         self.role = "FOLLOWER"
         self.candidate_id = None
-        self.votes = {
-            1: None,
-            2: None,
-            3: None,
-            4: None,
-            5: None,
-        }
+        self.votes = set()
         self.reset_timeout()
+        self._update_role()
 
 
 if __name__ == "__main__":
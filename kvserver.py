@@ -29,14 +29,33 @@ class KVServer:
     def handle_message(self, msg):
         return self._parse_message(msg)
 
-    def _parse_message(self, msg):
+    # Apply a committed command from the Raft log.  The Raft log already
+    # records it (and is compacted by snapshots), so it isn't kept in
+    # cmd_log as well.
+    def apply(self, command):
+        return self._parse_message(command.encode("utf-8"), record=False)
+
+    # Answer a read-only command, which Raft serves without the log
+    def query(self, command):
+        if command.split(" ", 1)[0] != "get":
+            return b"INVALID READ"
+        return self._parse_message(command.encode("utf-8"), record=False)
+
+    # The whole keyspace as bytes, for Raft snapshots
+    def dump(self):
+        return json.dumps(self.db).encode("utf-8")
+
+    def load(self, data):
+        self.db = json.loads(data)
+
+    def _parse_message(self, msg, record=True):
         # TODO: handle non byte-string?
         data = msg.decode("utf-8").strip().split(" ")
         if data and any(data[0] == cmd for cmd in self.commands):
             resp, err = self.commands[data[0]](data[1:])
 
             # Append to the log if the command was successful
-            if not err:
+            if not err and record:
                 self.append(data)
 
             return resp
@@ -55,13 +74,11 @@ class KVServer:
         key, value = args[0], " ".join(args[1:])
         self.db[key] = value
 
-        print(self.db)
-
         return b"OK", False
 
     def get(self, args):
         if not args:
-            return b"GET needs a key to look up"
+            return b"GET needs a key to look up", True
 
         key = args[0]
 
@@ -95,8 +112,8 @@ class KVServer:
         filename = f"{args[0]}.json"
 
         try:
-            with open(os.path.join(self.snapshot_dir, filename), "w") as f:
-                f.write(json.dumps(self.db))
+            with open(os.path.join(self.snapshot_dir, filename), "wb") as f:
+                f.write(self.dump())
         except Exception as e:
             print(e)
             return b"error saving snapshot", True
@@ -113,8 +130,8 @@ class KVServer:
         filename = f"{args[0]}.json"
 
         try:
-            with open(os.path.join(self.snapshot_dir, filename)) as f:
-                self.db = json.loads(f.read())
+            with open(os.path.join(self.snapshot_dir, filename), "rb") as f:
+                self.load(f.read())
         except Exception as e:
             print(e)
             return b"error restoring from snapshot", True
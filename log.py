@@ -1,3 +1,4 @@
+from bisect import bisect_left, bisect_right
 from itertools import zip_longest
 from dataclasses import dataclass
 
@@ -8,14 +9,215 @@ class LogEntry:
     command: str
 
 
+# An entry whose command starts with CONFIG_PREFIX holds a cluster
+# configuration rather than a state machine command: the node numbers
+# of the voting members, space separated, then those of any learners
+# after LEARNERS.  Learners are sent the log but don't vote.
+CONFIG_PREFIX = "\x00config "
+LEARNERS = " learners "
+
+
+def config_command(nodes, learners=()) -> str:
+    command = CONFIG_PREFIX + " ".join(str(nodenum) for nodenum in sorted(nodes))
+    if learners:
+        command += LEARNERS + " ".join(str(nodenum) for nodenum in sorted(learners))
+    return command
+
+
+# The voting nodes and learners in a configuration command, or None for
+# any other command
+def parse_config(command):
+    if not command.startswith(CONFIG_PREFIX):
+        return None
+    voters, _, learners = command[len(CONFIG_PREFIX) :].partition(LEARNERS)
+    return (
+        tuple(int(nodenum) for nodenum in voters.split()),
+        tuple(int(nodenum) for nodenum in learners.split()),
+    )
+
+
+@dataclass
+class Snapshot:
+    # State machine data with every entry up to and including index
+    # applied.  term is the term of that entry, config the voting nodes
+    # as of that entry (empty if it isn't known) and learners the
+    # non-voting ones.
+    index: int
+    term: int
+    data: bytes
+    config: tuple = ()
+    learners: tuple = ()
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    # size bytes of the data from offset, for sending it in chunks
+    def read(self, offset, size):
+        return self.data[offset : offset + size]
+
+
+class SnapshotBuffer:
+    # Collects a snapshot streamed to a RaftLog that has no storage.
+    # Storage backends provide their own writer with the same methods,
+    # such as wal.SnapshotWriter.
+    def __init__(self, index, term, config=(), learners=()):
+        self.index = index
+        self.term = term
+        self.config = tuple(config)
+        self.learners = tuple(learners)
+        self._data = bytearray()
+
+    @property
+    def received(self):
+        return len(self._data)
+
+    def write(self, data):
+        self._data += data
+
+    def abort(self):
+        self._data = bytearray()
+
+    def snapshot(self):
+        return Snapshot(
+            self.index, self.term, bytes(self._data), self.config, self.learners
+        )
+
+
+class CompactedEntries:
+    # A list-like log whose entries before start have been discarded.
+    # Indexes stay absolute: entry start stands in for the snapshot the
+    # way index 0 does for an empty log, and earlier ones are gone.
+    def __init__(self, start, term, entries):
+        self.start = start
+        self._entries = [LogEntry(term, "")] + entries
+
+    def __len__(self):
+        return self.start + len(self._entries)
+
+    def _position(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not self.start <= idx < len(self):
+            raise IndexError("log index out of range")
+        return idx - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if start < self.start and start < stop:
+                raise IndexError("log index has been compacted")
+            return self._entries[start - self.start : stop - self.start : step]
+        return self._entries[self._position(key)]
+
+    # Only dropping the end of the log, del entries[idx:], is supported
+    def __delitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        if stop != len(self) or step != 1:
+            raise ValueError("Can only delete the end of the log")
+        del self._entries[max(start - self.start, 1) :]
+
+    def append(self, entry):
+        self._entries.append(entry)
+
+    def extend(self, entries):
+        self._entries.extend(entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self._entries)
+
+
 class RaftLog:
-    def __init__(self):
+    # storage, if given, is a durable backend such as wal.WriteAheadLog.
+    # log_entries is then the list-like view it loads, and append_entry
+    # commits every change to it before returning.
+    def __init__(self, storage=None):
         self.log_entries = [LogEntry(0, "")]
-        # do we need either of these?
+        self.snapshot = None
+        self.storage = storage
+        self._incoming = None
+        if storage is not None:
+            self.log_entries = storage.load()
+            self.snapshot = storage.snapshot
+
+    # Index and term of the last entry covered by the snapshot, below
+    # which log_entries can't be read
+    @property
+    def snapshot_index(self):
+        return self.snapshot.index if self.snapshot is not None else 0
+
+    @property
+    def snapshot_term(self):
+        return self.snapshot.term if self.snapshot is not None else 0
+
+    # Replace everything up to snapshot.index with the snapshot.  Entries
+    # after it are kept if our log agrees with the snapshot, otherwise
+    # the log is emptied down to it.
+    def compact(self, snapshot: Snapshot):
+        if self.storage is not None:
+            # The storage keeps the data on disk rather than in memory
+            self.storage.compact(snapshot)
+            self.snapshot = self.storage.snapshot
+            return
+
+        keep = []
+        if (
+            snapshot.index < len(self.log_entries)
+            and self.log_entries[snapshot.index].term == snapshot.term
+        ):
+            keep = self.log_entries[snapshot.index + 1 :]
+        self.log_entries = CompactedEntries(snapshot.index, snapshot.term, keep)
+        self.snapshot = snapshot
+
+    # Take the next chunk of a snapshot being streamed to us.  Chunks are
+    # written as they arrive rather than held until the end, and must
+    # come in order: one that doesn't start where the last one ended is
+    # ignored.  A chunk of a different snapshot abandons the one in
+    # progress.  The last chunk (done) installs the snapshot like
+    # compact().  Returns how many bytes we have, which is where the
+    # sender should carry on from.
+    def receive_snapshot(
+        self, index, term, offset, data, done, config=(), learners=()
+    ):
+        incoming = self._incoming
+        if incoming is None or (incoming.index, incoming.term) != (index, term):
+            if incoming is not None:
+                incoming.abort()
+            if self.storage is not None:
+                incoming = self.storage.snapshot_writer(index, term, config, learners)
+            else:
+                incoming = SnapshotBuffer(index, term, config, learners)
+            self._incoming = incoming
+
+        if offset != incoming.received:
+            return incoming.received
+        incoming.write(data)
+        received = incoming.received
+        if done:
+            self._incoming = None
+            if self.storage is not None:
+                self.storage.install(incoming)
+                self.snapshot = self.storage.snapshot
+            else:
+                self.compact(incoming.snapshot())
+        return received
 
     # TODO: might not want to use term here -- move that up a layer...
     # TODO: why do we need leader_commit here?
     def append_entry(self, prev_log_idx, prev_log_term, entries):
+        if prev_log_idx < self.snapshot_index:
+            # Everything up to the snapshot is committed, so it matches
+            skip = self.snapshot_index - prev_log_idx
+            entries = entries[skip:]
+            prev_log_idx = self.snapshot_index
+            prev_log_term = self.snapshot_term
+
         if len(self.log_entries) <= prev_log_idx:
             return False
 
@@ -24,7 +226,10 @@ class RaftLog:
             return False
 
         if entries:
-            pairs = zip_longest(self.log_entries[prev_log_idx + 1 :], entries)
+            # Only the part of our log that overlaps the new entries
+            start = prev_log_idx + 1
+            current = self.log_entries[start : start + len(entries)]
+            pairs = zip_longest(current, entries)
             for idx, pair in enumerate(pairs, start=prev_log_idx + 1):
                 # current_entry is what the log already has
                 # entry is the entry we want to add
@@ -48,12 +253,48 @@ class RaftLog:
                     # add entries from here on to end of log
                     # print(self.log_entries)
                     # print(f"term at index {idx} does not match. deleting entries")
-                    self.log_entries = self.log_entries[:idx] + [append_entry]
+                    # Everything after the conflict is replaced as well
+                    del self.log_entries[idx:]
+                    self.log_entries.extend(entries[idx - prev_log_idx - 1 :])
+                    break
                 elif current_entry is None and append_entry:
                     self.log_entries.append(append_entry)
 
+        if self.storage is not None:
+            self.storage.commit()
+
         return True
 
+    # Where a rejected append_entry conflicts with this log, as the term
+    # of our entry at prev_log_idx and the first index holding that
+    # term.  If the log is too short the term is -1 and the index is
+    # our length.  Terms never decrease along a log, so bisect works.
+    def conflict_hint(self, prev_log_idx):
+        if prev_log_idx >= len(self.log_entries):
+            return -1, len(self.log_entries)
+        term = self.log_entries[prev_log_idx].term
+        first = bisect_left(
+            self.log_entries,
+            term,
+            lo=self.snapshot_index,
+            hi=prev_log_idx,
+            key=lambda entry: entry.term,
+        )
+        return term, first
+
+    # Index of our last entry with the given term, or None
+    def last_index_of_term(self, term):
+        idx = bisect_right(
+            self.log_entries,
+            term,
+            lo=self.snapshot_index,
+            key=lambda entry: entry.term,
+        )
+        idx -= 1
+        if idx >= self.snapshot_index and self.log_entries[idx].term == term:
+            return idx
+        return None
+
     def __str__(self):
         return str(self.log_entries)
 
@@ -4,8 +4,9 @@ from log import LogEntry
 
 def send_message(sock, msg):
     size = b"%10d" % len(msg)  # Make a 10-byte length field
-    sock.sendall(size)
-    sock.sendall(msg)
+    # One write per frame: on a long-lived connection a separate header
+    # write stalls on Nagle's algorithm until the peer's delayed ACK.
+    sock.sendall(size + msg)
 
 
 def recv_exactly(sock, nbytes):
@@ -25,6 +26,64 @@ def recv_message(sock):
     return msg
 
 
+# Tagged frames carry a request id so that many requests can be in
+# flight on one connection and replies can be matched up in any order.
+# The header is the marker byte, a 9-byte length and a 10-byte request
+# id.  A plain length header never starts with the marker, so both kinds
+# of frame can share a connection and old nodes keep working.
+TAG = b"R"
+
+
+def send_tagged_message(sock, request_id, msg):
+    header = TAG + b"%9d%10d" % (len(msg), request_id % 10**10)
+    sock.sendall(header + msg)
+
+
+# Receive either kind of frame.  request_id is None for a plain frame.
+def recv_frame(sock):
+    header = recv_exactly(sock, 10)
+    if header[:1] == TAG:
+        request_id = int(recv_exactly(sock, 10))
+        return request_id, recv_exactly(sock, int(header[1:]))
+    return None, recv_exactly(sock, int(header))
+
+
+# Reply in the same kind of frame the request came in
+def send_frame(sock, request_id, msg):
+    if request_id is None:
+        send_message(sock, msg)
+    else:
+        send_tagged_message(sock, request_id, msg)
+
+
+# asyncio stream versions of the above, using the same framing so
+# threaded and event-loop nodes can talk to each other.
+def write_message(writer, msg):
+    writer.write(b"%10d" % len(msg) + msg)
+
+
+async def read_message(reader):
+    size = int(await reader.readexactly(10))
+    msg = await reader.readexactly(size)
+    return msg
+
+
+def write_frame(writer, request_id, msg):
+    if request_id is None:
+        write_message(writer, msg)
+    else:
+        header = TAG + b"%9d%10d" % (len(msg), request_id % 10**10)
+        writer.write(header + msg)
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(10)
+    if header[:1] == TAG:
+        request_id = int(await reader.readexactly(10))
+        return request_id, await reader.readexactly(int(header[1:]))
+    return None, await reader.readexactly(int(header))
+
+
 @dataclass
 class AppendEntriesMessage:
     # Sent from leader to follower to replicate log entries
@@ -33,6 +92,9 @@ class AppendEntriesMessage:
     entries: list[LogEntry]
     leader_commit_index: int
     term: int
+    # The leader's latest read confirmation round, echoed back in the
+    # response so it knows which reads the follower has vouched for
+    read_seq: int = 0
 
 
 @dataclass
@@ -41,6 +103,12 @@ class AppendEntriesResponse:
     last_applied_index: int
     term: int
     nodenum: int
+    # On rejection: the term of the follower's entry at prev_log_idx and
+    # the first index of that term (term -1 if its log is too short).
+    # conflict_index -1 means no hint.
+    conflict_term: int = -1
+    conflict_index: int = -1
+    read_seq: int = 0
 
 
 @dataclass
@@ -48,6 +116,13 @@ class NewCommandMessage:
     command: str
 
 
+@dataclass
+class ReadMessage:
+    # A read-only command, such as "get x", answered by the leader from
+    # its state machine without going through the log
+    command: str
+
+
 @dataclass
 class RequestVoteMessage:
     term: int
@@ -63,6 +138,46 @@ class RequestVoteResponse:
     nodenum: int
 
 
+@dataclass
+class InstallSnapshotMessage:
+    # One chunk of the leader's snapshot, sent to a follower whose next
+    # entry has been compacted away.  data starts offset bytes into the
+    # snapshot and done marks the last chunk.  The follower answers
+    # with an InstallSnapshotResponse until it has every chunk, then
+    # with an AppendEntriesResponse.
+    term: int
+    leader_id: int
+    last_included_index: int
+    last_included_term: int
+    offset: int
+    data: bytes
+    done: bool
+    # The voting nodes and learners as of last_included_index
+    config: tuple = ()
+    learners: tuple = ()
+
+
+@dataclass
+class InstallSnapshotResponse:
+    # offset is how many bytes of the snapshot the follower has, which
+    # is where the leader should carry on from
+    term: int
+    nodenum: int
+    last_included_index: int
+    offset: int
+
+
+@dataclass
+class MembershipChangeMessage:
+    # Sent to the leader to add a voting node to the cluster, or remove
+    # one if add is False.  Only one node changes at a time.  With
+    # learner the node is added as a learner instead, and adding a
+    # learner as a voter promotes it once it has caught up.
+    nodenum: int
+    add: bool
+    learner: bool = False
+
+
 @dataclass
 class ClockTick:
     milliseconds: float
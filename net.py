@@ -1,13 +1,87 @@
 import random
-from threading import Thread
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
-from message import send_message, recv_message
+from collections import defaultdict
+from concurrent.futures import Future
+from itertools import count
+from threading import Thread, Lock
+from socket import (
+    socket,
+    AF_INET,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    SO_REUSEADDR,
+    IPPROTO_TCP,
+    TCP_NODELAY,
+)
+from message import (
+    send_message,
+    recv_message,
+    send_tagged_message,
+    recv_frame,
+    send_frame,
+)
 
 from config import SERVERS
 
 
+class PipelinedConnection:
+    # A single socket carrying many outstanding requests.  Every request
+    # goes out in a tagged frame and a reader thread hands each reply to
+    # the future waiting on its request id, so replies may come back in
+    # any order and the sender never waits for a round trip.
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        self._ids = count(1)
+        self._pending = {}
+        self._lock = Lock()
+        Thread(target=self._read_replies, daemon=True).start()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def request(self, message: bytes) -> Future:
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise IOError("Connection closed")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            try:
+                send_tagged_message(self.sock, request_id, message)
+            except Exception:
+                del self._pending[request_id]
+                raise
+        return future
+
+    def _read_replies(self):
+        try:
+            while True:
+                request_id, msg = recv_frame(self.sock)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(msg)
+        except Exception as e:
+            self.close(e)
+
+    def close(self, exc=None):
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        self.sock.close()
+        for future in pending.values():
+            future.set_exception(exc or IOError("Connection closed"))
+
+
 class RaftNet:
-    def __init__(self, nodenum: int = None):
+    def __init__(
+        self,
+        nodenum: int = None,
+        pooled: bool = True,
+        max_idle: int = 4,
+        pipelined: bool = False,
+    ):
         # My own address
         self.nodenum = nodenum
         self.addr = SERVERS.get(nodenum)
@@ -19,32 +93,131 @@ class RaftNet:
         self.sock.bind(self.addr)
         self.sock.listen()
 
+        # Idle connections to each peer.  A send checks a connection out
+        # of the pool and puts it back once the reply has been read, so
+        # concurrent sends to one peer never share a socket.
+        self.pooled = pooled
+        self.max_idle = max_idle
+        self._pool = defaultdict(list)
+        self._pool_lock = Lock()
+        self.connects = 0
+        self.reuses = 0
+
+        # With pipelined=True every peer gets one PipelinedConnection
+        # instead of the pool.  Peers must understand tagged frames.
+        self.pipelined = pipelined
+        self._pipelines = {}
+
     # Send a message to a specific node number
     def send(self, destination: int, message: bytes):
-        addr = SERVERS.get(destination)
+        try:
+            if self.pipelined:
+                return self.send_async(destination, message).result()
+            return self._send(destination, message)
+        except Exception as e:
+            return e
+
+    # Send a message without waiting for the reply.  The returned future
+    # holds the reply, or the exception if the send failed.
+    def send_async(self, destination: int, message: bytes) -> Future:
+        try:
+            try:
+                return self._pipeline(destination).request(message)
+            except IOError:
+                # The peer dropped the connection; reconnect once
+                self._pipelines.pop(destination, None)
+                return self._pipeline(destination).request(message)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def _pipeline(self, destination):
+        with self._pool_lock:
+            conn = self._pipelines.get(destination)
+            if conn is not None and not conn.closed:
+                self.reuses += 1
+                return conn
+            self.connects += 1
+            conn = self._pipelines[destination] = PipelinedConnection(
+                self._connect(destination)
+            )
+            return conn
 
+    def _send(self, destination, message):
+        sock, reused = self._checkout(destination)
         try:
-            sock = socket(AF_INET, SOCK_STREAM)
-            sock.connect(addr)
             send_message(sock, message)
             response = recv_message(sock)
-            return response
-        except Exception as e:
-            return e
-        finally:
+        except IOError:
+            sock.close()
+            if not reused:
+                raise
+            # The peer went away since this connection was pooled.  Every
+            # other idle connection to it is stale too, so drop them all
+            # and retry once on a fresh connection.
+            self.drop(destination)
+            return self._send(destination, message)
+        except Exception:
+            sock.close()
+            raise
+
+        self._checkin(destination, sock)
+        return response
+
+    def _checkout(self, destination):
+        with self._pool_lock:
+            idle = self._pool[destination]
+            if idle:
+                self.reuses += 1
+                return idle.pop(), True
+            self.connects += 1
+        return self._connect(destination), False
+
+    def _connect(self, destination):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, True)
+        try:
+            sock.connect(SERVERS.get(destination))
+        except Exception:
             sock.close()
+            raise
+        return sock
+
+    def _checkin(self, destination, sock):
+        with self._pool_lock:
+            idle = self._pool[destination]
+            if self.pooled and len(idle) < self.max_idle:
+                idle.append(sock)
+                return
+        sock.close()
+
+    # Close every idle connection to a node
+    def drop(self, destination: int):
+        with self._pool_lock:
+            idle = self._pool.pop(destination, [])
+        for sock in idle:
+            sock.close()
+
+    # Close every idle connection to every node
+    def close(self):
+        for destination in list(self._pool):
+            self.drop(destination)
+        for conn in list(self._pipelines.values()):
+            conn.close()
+        self._pipelines.clear()
 
     # Receive and return any message that was sent to me
     def receive(self, handle_message=None) -> bytes:
         def handle_messages(sock, handle_message):
             try:
                 while True:
-                    msg = recv_message(sock)
+                    request_id, msg = recv_frame(sock)
                     if handle_message:
                         resp = handle_message(msg)
                     else:
                         resp = self.kv.handle_message(msg)
-                    send_message(sock, resp)
+                    send_frame(sock, request_id, resp)
             except IOError:
                 sock.close()
 
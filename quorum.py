@@ -0,0 +1,46 @@
+from bisect import bisect_left, insort
+
+
+class QuorumTracker:
+    # The match index of every voting node, and the highest index that a
+    # majority of them have reached, which is what a leader may commit.
+    #
+    # The match indexes are also kept in a sorted list, so an update is
+    # two binary searches and the majority index is read straight off
+    # it, rather than sorting every node's index on every response.
+    # Match indexes only move forwards: a late answer to an old request
+    # can't take one back.
+    def __init__(self, nodes, initial=0):
+        self._match = {nodenum: initial for nodenum in nodes}
+        self._sorted = [initial] * len(self._match)
+
+    @property
+    def quorum(self):
+        return len(self._match) // 2 + 1
+
+    # Highest index held by at least a quorum of nodes
+    @property
+    def committed(self):
+        return self._sorted[len(self._sorted) - self.quorum]
+
+    def __getitem__(self, nodenum):
+        return self._match[nodenum]
+
+    def __contains__(self, nodenum):
+        return nodenum in self._match
+
+    def __len__(self):
+        return len(self._match)
+
+    def as_dict(self):
+        return dict(self._match)
+
+    # Record that nodenum has the log up to index, returning the
+    # committed index
+    def update(self, nodenum, index):
+        old = self._match[nodenum]
+        if index > old:
+            self._match[nodenum] = index
+            del self._sorted[bisect_left(self._sorted, old)]
+            insort(self._sorted, index)
+        return self.committed
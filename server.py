@@ -1,22 +1,64 @@
-# TODO: pickle isn't secure...
-import pickle
+import os
 import time
 
+from concurrent.futures import Future, TimeoutError
 from threading import Thread
 
+from codec import CODECS
+from log import RaftLog
+from wal import WriteAheadLog
 from net import RaftNet
 from message import ClockTick
 from controller import RaftController
+from kvserver import KVServer
+from config import SERVERS
+
+
+# Most client commands a leader appends and replicates in one batch.
+# With no proposal_window a batch is whatever has queued up while the
+# last one was handled, so batching adds no delay.
+PROPOSAL_BATCH = 256
+
+# Seconds a client waits for a read, e.g. while a leader that has been
+# cut off from the cluster can't confirm it still leads
+READ_TIMEOUT = 5.0
 
 
 class RaftServer:
-    def __init__(self, nodenum, leader=False):
+    # codec picks the wire encoding, see codec.CODECS.  pickle isn't
+    # secure, so prefer "binary" for anything exposed to a network.
+    # With a data_dir the log is kept in a write-ahead log there.
+    # Committed commands are applied to a KVServer, and any other
+    # options (e.g. snapshot_threshold) are passed to RaftController.
+    # Client commands are batched, see PROPOSAL_BATCH.  cluster is the
+    # initial voting membership, every node in config.SERVERS by default;
+    # it then changes through MembershipChangeMessages to the leader.
+    def __init__(
+        self,
+        nodenum,
+        leader=False,
+        pipelined=False,
+        codec="pickle",
+        data_dir=None,
+        **options,
+    ):
         self.nodenum = nodenum
         role = "FOLLOWER"
         if leader:
             role = "LEADER"
-        self.net = RaftNet(nodenum)  # TODO: make this not be a network if we want
-        self.controller = RaftController(nodenum, role)
+        # TODO: make this not be a network if we want
+        self.net = RaftNet(nodenum, pipelined=pipelined)
+        self.dumps, self.loads = CODECS[codec]
+        self.kv = KVServer()
+        options.setdefault("proposal_batch", PROPOSAL_BATCH)
+        options.setdefault("cluster", tuple(SERVERS))
+        self.controller = RaftController(
+            nodenum,
+            role,
+            log=open_log(nodenum, data_dir),
+            state_machine=self.kv,
+            **options,
+        )
         Thread(target=self.net.receive, args=[self.handle_message]).start()
         Thread(target=self.handle_incoming, args=[]).start()
         Thread(target=self.handle_outgoing, args=[]).start()
@@ -35,37 +77,65 @@ class RaftServer:
     def handle_outgoing(self):
         while True:
             msg = self.controller.handle_outgoing()
-            # Fan out requests to every node.
-            for nodenum in [1, 2, 3, 4, 5]:
-                if nodenum != self.nodenum:
+            # Fan out requests to every node in the cluster.
+            for nodenum in self.controller.peers:
+                if self.net.pipelined:
+                    # Replies are matched up by the connection's reader
+                    # thread, so there is no need to wait for them here.
+                    self.net.send_async(nodenum, self.dumps(msg))
+                else:
                     Thread(target=self.send, args=[nodenum, msg]).start()
 
     def handle_message(self, msg):
-        msg = pickle.loads(msg)
+        msg = self.loads(msg)
         resp = self.controller.receive(msg)
-        if isinstance(resp, bytes):
-            return resp
-        elif resp:
-            return b"ok"
-        else:
-            return b"fail"
+        if isinstance(resp, Future):
+            try:
+                resp = resp.result(READ_TIMEOUT)
+            except TimeoutError:
+                resp = READ_TIMED_OUT
+        return reply(resp)
 
     def send(self, nodenum, msg):
-        self.net.send(nodenum, pickle.dumps(msg))
+        self.net.send(nodenum, self.dumps(msg))
 
     def receive(self, msg):
         self.net.receive(msg)
 
 
+# The log for a node, durable if there is a data directory
+def open_log(nodenum, data_dir=None):
+    if data_dir is None:
+        return RaftLog()
+    return RaftLog(WriteAheadLog(os.path.join(data_dir, f"node{nodenum}")))
+
+
+READ_TIMED_OUT = b"read timed out"
+
+
+# Turn a controller result into the bytes sent back to the peer
+def reply(resp):
+    if isinstance(resp, bytes):
+        return resp
+    elif resp:
+        return b"ok"
+    else:
+        return b"fail"
+
+
+# Seconds to sleep before the next tick and the milliseconds it reports.
+# These have to agree, as lease reads time the lease by the ticks.  A
+# leader ticks more often, as each tick sends a heartbeat.
+def tick_interval(controller):
+    if controller.role == "LEADER":
+        return 0.05, 50.0
+    return 0.1, 100.0
+
+
 def clock(controller):
     while True:
-        interval = 0
-        if controller.role == "LEADER":
-            time.sleep(0.50)
-            interval = 50.0
-        else:
-            time.sleep(0.1)
-            interval = 100.0
+        delay, interval = tick_interval(controller)
+        time.sleep(delay)
         msg = ClockTick(interval)
         controller.receive(msg)
 
@@ -1,13 +1,39 @@
-from controller import RaftController
+import asyncio
+import os
+import pickle
+import random
+import socket
+import time
+
+from threading import Thread
+
+from aionet import AsyncRaftNet
+from aioserver import AsyncRaftServer
+from codec import encode, decode, VERSION
+from config import SERVERS
+from controller import RaftController, NOT_LEADER
+from kvserver import KVServer
+from net import RaftNet, PipelinedConnection
 from message import (
     NewCommandMessage,
     AppendEntriesMessage,
     AppendEntriesResponse,
     RequestVoteMessage,
     RequestVoteResponse,
+    InstallSnapshotMessage,
+    InstallSnapshotResponse,
+    MembershipChangeMessage,
+    ReadMessage,
     ClockTick,
+    send_message,
+    recv_frame,
+    send_frame,
+    write_message,
+    read_message,
 )
-from log import RaftLog, LogEntry
+from log import RaftLog, LogEntry, Snapshot, config_command
+from wal import WriteAheadLog
+from quorum import QuorumTracker
 
 
 class TestRaftLog:
@@ -120,7 +146,8 @@ class TestRaftControllerReplication:
             LogEntry(0, "set x 1"),
         ]
         msg = controller.outgoing_messages.get_nowait()
-        assert msg == AppendEntriesMessage(0, 0, [LogEntry(0, "set x 1")], 1, 0)
+        # nothing is committed until a majority has the entry
+        assert msg == AppendEntriesMessage(0, 0, [LogEntry(0, "set x 1")], 0, 0)
 
     def test_receive_append_entries_message(self):
         controller = RaftController(1, False)
@@ -290,6 +317,157 @@ class TestRaftControllerCommits:
         pass
 
 
+# Pass messages back and forth between a leader and one follower until
+# both go quiet, returning the number of round trips
+def exchange(leader, follower):
+    round_trips = 0
+    while leader.outgoing_messages.qsize():
+        follower.handle_message(leader.outgoing_messages.get_nowait())
+        while follower.outgoing_messages.qsize():
+            leader.handle_message(follower.outgoing_messages.get_nowait())
+        round_trips += 1
+    return round_trips
+
+
+class TestRaftControllerBatching:
+    def test_fresh_follower_catches_up_in_batches(self):
+        leader = RaftController(1, "LEADER", initial_batch_entries=4)
+        leader.log.log_entries.extend(LogEntry(0, f"set x {i}") for i in range(100))
+        follower = RaftController(2)
+
+        leader.send_heartbeat()
+        round_trips = exchange(leader, follower)
+        assert follower.log.log_entries == leader.log.log_entries
+        # heartbeat, then batches of 4, 8, 16, 32 and 64
+        assert round_trips == 6
+        assert leader.next_index[2] == 101
+        assert leader.last_applied_indexes[2] == 100
+
+    def test_batches_capped_by_entries_and_bytes(self):
+        leader = RaftController(
+            1, "LEADER", max_batch_entries=8, max_batch_bytes=100
+        )
+        leader.log.log_entries.extend(LogEntry(0, "x" * 30) for i in range(20))
+        leader.receive(AppendEntriesResponse(False, 0, 0, 2))
+        leader.handle_incoming()
+        msg = leader.outgoing_messages.get_nowait()
+        assert msg.prev_log_idx == 0
+        # 46 bytes an entry, so two fit under the cap
+        assert len(msg.entries) == 2
+
+        leader.max_batch_bytes = 1 << 20
+        leader.receive(AppendEntriesResponse(True, 2, 0, 2))
+        leader.handle_incoming()
+        msg = leader.outgoing_messages.get_nowait()
+        assert msg.prev_log_idx == 2
+        assert len(msg.entries) == 8
+
+    def test_slow_follower_gets_smaller_batches(self):
+        leader = RaftController(1, "LEADER", initial_batch_entries=16)
+        leader.log.log_entries.extend(LogEntry(0, "") for i in range(100))
+        leader.receive(AppendEntriesResponse(False, 0, 0, 2))
+        leader.handle_incoming()
+        assert len(leader.outgoing_messages.get_nowait().entries) == 16
+
+        # no answer before the next tick
+        leader.receive(ClockTick(50.0))
+        leader.handle_incoming()
+        leader.outgoing_messages.get_nowait()
+        assert leader.batch_size(2) == 8
+
+    def test_divergent_logs_reconcile_a_term_per_round_trip(self):
+        # After a partition the follower has 50 entries from each of
+        # terms 2, 3 and 4 that the leader never saw
+        leader = RaftController(1, "LEADER")
+        leader.term = 5
+        leader.log.log_entries.extend(LogEntry(1, f"a{i}") for i in range(50))
+        leader.log.log_entries.extend(LogEntry(5, f"b{i}") for i in range(150))
+        follower = RaftController(2)
+        follower.log.log_entries.extend(LogEntry(1, f"a{i}") for i in range(50))
+        for term in (2, 3, 4):
+            follower.log.log_entries.extend(LogEntry(term, "") for i in range(50))
+
+        leader.send_heartbeat()
+        round_trips = exchange(leader, follower)
+        assert follower.log.log_entries == leader.log.log_entries
+        # heartbeat and a rejection per divergent term, then catch up
+        assert round_trips < 10
+
+    def test_conflict_hint(self):
+        rl = RaftLog()
+        rl.log_entries += [LogEntry(1, ""), LogEntry(2, ""), LogEntry(2, "")]
+        assert rl.conflict_hint(3) == (2, 2)
+        assert rl.conflict_hint(1) == (1, 1)
+        assert rl.conflict_hint(5) == (-1, 4)
+        assert rl.last_index_of_term(2) == 3
+        assert rl.last_index_of_term(3) is None
+
+    def test_rejected_append_backs_up_next_index(self):
+        leader = RaftController(1, "LEADER")
+        leader.log.log_entries.extend(LogEntry(0, "") for i in range(10))
+        leader.next_index[2] = 8
+        leader.receive(AppendEntriesResponse(False, 9, 0, 2))
+        leader.handle_incoming()
+        msg = leader.outgoing_messages.get_nowait()
+        assert msg.prev_log_idx == 6
+        assert len(msg.entries) == 4
+        # next_index moves past the batch as soon as it is sent
+        assert leader.next_index[2] == 11
+
+    def test_late_success_does_not_resend(self):
+        leader = RaftController(1, "LEADER", initial_batch_entries=4)
+        leader.log.log_entries.extend(LogEntry(0, f"set x {i}") for i in range(8))
+        leader.next_index[2] = 1
+        leader.replicate(2)
+        leader.replicate(2)
+        assert leader.next_index[2] == 9
+        while leader.outgoing_messages.qsize():
+            leader.outgoing_messages.get_nowait()
+
+        # the answer to the first batch arrives after the second was sent
+        leader.receive(AppendEntriesResponse(True, 4, 0, 2))
+        leader.handle_incoming()
+        assert leader.next_index[2] == 9
+        assert leader.outgoing_messages.qsize() == 0
+
+
+class TestQuorumTracker:
+    def test_matches_sorting(self):
+        rng = random.Random(7)
+        for size in (1, 2, 3, 4, 5, 8, 51):
+            nodes = list(range(1, size + 1))
+            tracker = QuorumTracker(nodes)
+            match = dict.fromkeys(nodes, 0)
+            for _ in range(500):
+                nodenum = rng.choice(nodes)
+                match[nodenum] = max(match[nodenum], rng.randrange(1000))
+                committed = tracker.update(nodenum, match[nodenum])
+                majority = sorted(match.values(), reverse=True)[size // 2]
+                assert committed == majority
+            assert tracker.as_dict() == match
+
+    def test_late_answer_ignored(self):
+        tracker = QuorumTracker([1, 2, 3])
+        tracker.update(2, 10)
+        assert tracker.update(1, 8) == 8
+        assert tracker.update(2, 4) == 8
+        assert tracker[2] == 10
+
+    def test_controller_commits_with_majority_of_cluster(self):
+        leader = RaftController(1, "LEADER", cluster=range(1, 8))
+        leader.log.log_entries.extend(LogEntry(0, "") for i in range(5))
+        for nodenum in (2, 3):
+            leader.update_last_applied(nodenum, 5)
+        assert leader.commit_index == 0
+        leader.update_last_applied(4, 3)
+        assert leader.commit_index == 3
+        # nodes outside the cluster don't count
+        leader.update_last_applied(9, 5)
+        assert leader.commit_index == 3
+        leader.update_last_applied(5, 5)
+        assert leader.commit_index == 5
+
+
 class TestRaftControllerConsensus:
     def test_vote_only_once(self):
         pass
@@ -347,3 +525,967 @@ class TestRaftControllerConsensus:
         controller.handle_incoming()
         assert controller.term == 1
         assert controller.role == "CANDIDATE"
+
+
+def free_node():
+    # Register a spare node number on a free localhost port
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    nodenum = max(SERVERS) + 1
+    SERVERS[nodenum] = ("localhost", port)
+    return nodenum
+
+
+class TestRaftNet:
+    def test_pooled_connections_are_reused(self):
+        nodenum = free_node()
+        server = RaftNet(nodenum)
+        Thread(target=server.receive, args=[lambda msg: msg], daemon=True).start()
+
+        client = RaftNet(pooled=True)
+        assert client.send(nodenum, b"one") == b"one"
+        assert client.send(nodenum, b"two") == b"two"
+        assert client.send(nodenum, b"three") == b"three"
+        assert client.connects == 1
+        assert client.reuses == 2
+        client.close()
+        del SERVERS[nodenum]
+
+    def test_unpooled_connects_every_send(self):
+        nodenum = free_node()
+        server = RaftNet(nodenum)
+        Thread(target=server.receive, args=[lambda msg: msg], daemon=True).start()
+
+        client = RaftNet(pooled=False)
+        assert client.send(nodenum, b"one") == b"one"
+        assert client.send(nodenum, b"two") == b"two"
+        assert client.connects == 2
+        assert client.reuses == 0
+        del SERVERS[nodenum]
+
+    def test_reconnect_after_peer_drops(self):
+        nodenum = free_node()
+        server = RaftNet(nodenum)
+        Thread(target=server.receive, args=[lambda msg: msg], daemon=True).start()
+
+        client = RaftNet(pooled=True)
+        assert client.send(nodenum, b"one") == b"one"
+        # Kill the pooled connection from underneath the client
+        client._pool[nodenum][0].shutdown(socket.SHUT_RDWR)
+        assert client.send(nodenum, b"two") == b"two"
+        assert client.connects == 2
+        client.close()
+        del SERVERS[nodenum]
+
+
+class TestPipelinedFraming:
+    def test_plain_and_tagged_frames_share_a_connection(self):
+        a, b = socket.socketpair()
+        send_message(a, b"plain")
+        send_frame(a, 42, b"tagged")
+        assert recv_frame(b) == (None, b"plain")
+        assert recv_frame(b) == (42, b"tagged")
+        a.close()
+        b.close()
+
+    def test_out_of_order_replies(self):
+        a, b = socket.socketpair()
+        conn = PipelinedConnection(a)
+        first = conn.request(b"first")
+        second = conn.request(b"second")
+        assert conn.in_flight == 2
+
+        requests = [recv_frame(b), recv_frame(b)]
+        for request_id, msg in reversed(requests):
+            send_frame(b, request_id, msg.upper())
+
+        assert second.result(timeout=1) == b"SECOND"
+        assert first.result(timeout=1) == b"FIRST"
+        assert conn.in_flight == 0
+        conn.close()
+        b.close()
+
+    def test_pending_requests_fail_when_peer_drops(self):
+        a, b = socket.socketpair()
+        conn = PipelinedConnection(a)
+        future = conn.request(b"lost")
+        b.close()
+        assert isinstance(future.exception(timeout=1), IOError)
+        assert conn.closed
+
+    def test_pipelined_raftnet(self):
+        nodenum = free_node()
+        server = RaftNet(nodenum)
+        Thread(target=server.receive, args=[lambda msg: msg], daemon=True).start()
+
+        client = RaftNet(pipelined=True)
+        futures = [client.send_async(nodenum, b"%d" % i) for i in range(50)]
+        assert [f.result(timeout=1) for f in futures] == [b"%d" % i for i in range(50)]
+        assert client.send(nodenum, b"sync") == b"sync"
+        assert client.connects == 1
+        client.close()
+        del SERVERS[nodenum]
+
+
+class TestAsyncRaftNet:
+    def test_threaded_client_to_async_server(self):
+        nodenum = free_node()
+
+        async def run():
+            server = AsyncRaftNet(nodenum)
+            await server.start(lambda msg: msg.upper())
+            client = RaftNet(pooled=True)
+            loop = asyncio.get_running_loop()
+            resp = await loop.run_in_executor(None, client.send, nodenum, b"hi")
+            client.close()
+            await server.close()
+            return resp
+
+        assert asyncio.run(run()) == b"HI"
+        del SERVERS[nodenum]
+
+    def test_async_client_multiplexes_one_stream(self):
+        nodenum = free_node()
+        received = []
+
+        async def run():
+            server = AsyncRaftNet(nodenum)
+            await server.start(lambda msg: received.append(msg) or b"ok")
+            client = AsyncRaftNet()
+            for i in range(10):
+                client.send(nodenum, b"%d" % i)
+            while len(received) < 10:
+                await asyncio.sleep(0.01)
+            await client.close()
+            await server.close()
+            return client.connects
+
+        assert asyncio.run(run()) == 1
+        assert received == [b"%d" % i for i in range(10)]
+        del SERVERS[nodenum]
+
+    def test_pipelined_async_client(self):
+        nodenum = free_node()
+        received = []
+
+        async def run():
+            server = AsyncRaftNet(nodenum)
+            await server.start(lambda msg: received.append(msg) or b"ok")
+            client = AsyncRaftNet(pipelined=True)
+            for i in range(10):
+                client.send(nodenum, b"%d" % i)
+            while len(received) < 10:
+                await asyncio.sleep(0.01)
+            await client.close()
+            await server.close()
+            return client.connects
+
+        assert asyncio.run(run()) == 1
+        assert received == [b"%d" % i for i in range(10)]
+        del SERVERS[nodenum]
+
+    def test_server_drives_controller(self):
+        async def run():
+            server = AsyncRaftServer(1, leader=True)
+            resp = server.handle_message(pickle.dumps(NewCommandMessage("set x 1")))
+            await server.net.close()
+            return server, resp
+
+        server, resp = asyncio.run(run())
+        assert resp == b"ok"
+        assert server.log == [LogEntry(0, ""), LogEntry(0, "set x 1")]
+        assert server.controller.incoming_messages.qsize() == 0
+        assert server.controller.outgoing_messages.qsize() == 0
+
+
+class TestProposalBatching:
+    def drain(self, controller):
+        while controller.incoming_messages.qsize():
+            controller.handle_incoming()
+        if controller.proposal_delay() is not None:
+            controller.handle_incoming()
+        sent = []
+        while controller.outgoing_messages.qsize():
+            sent.append(controller.outgoing_messages.get_nowait())
+        return sent
+
+    def test_queued_commands_replicate_together(self):
+        leader = RaftController(1, "LEADER", proposal_batch=100)
+        for i in range(10):
+            leader.receive(NewCommandMessage(f"set x {i}"))
+        sent = self.drain(leader)
+        entries = [LogEntry(0, f"set x {i}") for i in range(10)]
+        assert sent == [AppendEntriesMessage(0, 0, entries, 0, 0)]
+        assert leader.log.log_entries[1:] == entries
+
+    def test_batches_are_capped(self):
+        leader = RaftController(1, "LEADER", proposal_batch=4)
+        for i in range(10):
+            leader.receive(NewCommandMessage(f"set x {i}"))
+        sent = self.drain(leader)
+        assert [len(msg.entries) for msg in sent] == [4, 4, 2]
+        assert [msg.prev_log_idx for msg in sent] == [0, 4, 8]
+
+        leader = RaftController(1, "LEADER", proposal_batch=100, max_batch_bytes=64)
+        for i in range(10):
+            leader.receive(NewCommandMessage("x" * 20))
+        assert [len(msg.entries) for msg in self.drain(leader)] == [2, 2, 2, 2, 2]
+
+    def test_window_waits_for_more_commands(self):
+        leader = RaftController(1, "LEADER", proposal_batch=100, proposal_window=0.05)
+        leader.receive(NewCommandMessage("set x 1"))
+        leader.handle_incoming()
+        assert 0 < leader.proposal_delay() <= 0.05
+        Thread(target=leader.receive, args=[NewCommandMessage("set y 2")]).start()
+        leader.handle_incoming()
+        assert leader.outgoing_messages.qsize() == 0
+
+        start = time.monotonic()
+        leader.handle_incoming()
+        assert time.monotonic() - start > 0.02
+        msg = leader.outgoing_messages.get_nowait()
+        assert msg.entries == [LogEntry(0, "set x 1"), LogEntry(0, "set y 2")]
+        assert leader.proposal_delay() is None
+
+    def test_dropped_after_stepping_down(self):
+        leader = RaftController(1, "LEADER", proposal_batch=100)
+        leader.receive(NewCommandMessage("set x 1"))
+        leader.handle_incoming()
+        leader.receive(AppendEntriesMessage(0, 0, [], 0, 1))
+        leader.handle_incoming()
+        assert leader.role == "FOLLOWER"
+        leader.handle_incoming()
+        assert len(leader.log.log_entries) == 1
+        assert leader.outgoing_messages.get_nowait().success
+        assert leader.outgoing_messages.qsize() == 0
+
+    def test_async_server_flushes_after_window(self):
+        async def run():
+            server = AsyncRaftServer(1, leader=True, proposal_window=0.02)
+            for i in range(3):
+                server.handle_message(pickle.dumps(NewCommandMessage(f"set x {i}")))
+            before = len(server.log)
+            await asyncio.sleep(0.1)
+            await server.net.close()
+            return before, server
+
+        before, server = asyncio.run(run())
+        assert before == 1
+        assert server.log[1:] == [LogEntry(0, f"set x {i}") for i in range(3)]
+
+
+class TestBinaryCodec:
+    def test_roundtrip(self):
+        messages = [
+            AppendEntriesMessage(3, 2, [LogEntry(2, "set x 1"), LogEntry(3, "")], 1, 3),
+            AppendEntriesMessage(0, 0, [], 0, 0),
+            AppendEntriesResponse(True, 5, 2, 4),
+            AppendEntriesResponse(False, 5, 2, 4, 1, 3),
+            NewCommandMessage("set ключ значение"),
+            RequestVoteMessage(term=2, candidate_id=3, last_log_index=9, last_log_term=1),
+            RequestVoteResponse(False, 7, 2),
+            InstallSnapshotMessage(3, 1, 40, 2, 1024, b'{"x": "1"}', True),
+            InstallSnapshotResponse(3, 2, 40, 1034),
+            ClockTick(12.5),
+        ]
+        for msg in messages:
+            assert decode(encode(msg)) == msg
+
+    def test_smaller_than_pickle(self):
+        entries = [LogEntry(2, f"set x {i}") for i in range(10)]
+        msg = AppendEntriesMessage(3, 2, entries, 1, 3)
+        assert len(encode(msg)) < len(pickle.dumps(msg))
+
+        heartbeat = AppendEntriesMessage(3, 2, [], 1, 3)
+        assert len(encode(heartbeat)) < len(pickle.dumps(heartbeat)) / 2.5
+
+    def test_rejects_bad_input(self):
+        data = encode(ClockTick(1.0))
+        wrong_version = bytes([VERSION + 1]) + data[1:]
+        for bad in [wrong_version, data[:1] + b"\xff" + data[2:], data + b"x"]:
+            try:
+                decode(bad)
+            except ValueError:
+                pass
+            else:
+                assert False, bad
+
+
+class TestWriteAheadLog:
+    def test_log_survives_restart(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        assert rl.append_entry(0, 0, [LogEntry(1, "set x 1"), LogEntry(1, "set y 2")])
+        assert rl.append_entry(2, 1, [LogEntry(2, "set z 3")])
+        rl.storage.close()
+
+        assert RaftLog(WriteAheadLog(tmp_path)).log_entries == rl.log_entries
+
+    def test_truncation_is_replayed(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        rl.append_entry(0, 0, [LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(1, "c")])
+        rl.append_entry(1, 1, [LogEntry(2, "x")])
+        assert rl.log_entries == [LogEntry(0, ""), LogEntry(1, "a"), LogEntry(2, "x")]
+        rl.storage.close()
+
+        assert RaftLog(WriteAheadLog(tmp_path)).log_entries == rl.log_entries
+
+    def test_one_fsync_per_batch(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        rl.append_entry(0, 0, [LogEntry(1, str(i)) for i in range(100)])
+        assert rl.storage.records == 100
+        assert rl.storage.fsyncs == 1
+
+    def test_fsync_window_groups_commits(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path, fsync_window=60.0))
+        for i in range(10):
+            rl.append_entry(i, rl.log_entries[i].term, [LogEntry(1, str(i))])
+        assert rl.storage.fsyncs == 1
+        rl.storage.close()
+        assert rl.storage.fsyncs == 2
+
+    def test_segment_rotation(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path, segment_bytes=256))
+        for i in range(50):
+            rl.append_entry(i, rl.log_entries[i].term, [LogEntry(1, "set x %d" % i)])
+        rl.storage.close()
+        assert len(rl.storage.segments) > 5
+
+        assert RaftLog(WriteAheadLog(tmp_path)).log_entries == rl.log_entries
+
+    def test_torn_tail_is_discarded(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        rl.append_entry(0, 0, [LogEntry(1, "a"), LogEntry(1, "b")])
+        rl.storage.close()
+        [segment] = rl.storage.segments
+        with open(segment, "r+b") as f:
+            f.truncate(f.seek(0, 2) - 1)
+
+        reloaded = RaftLog(WriteAheadLog(tmp_path))
+        assert reloaded.log_entries == [LogEntry(0, ""), LogEntry(1, "a")]
+        # and the log can be appended to afterwards
+        reloaded.append_entry(1, 1, [LogEntry(1, "c")])
+        reloaded.storage.close()
+        assert RaftLog(WriteAheadLog(tmp_path)).log_entries == reloaded.log_entries
+
+    def test_corrupt_record_is_discarded(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        rl.append_entry(0, 0, [LogEntry(1, "a"), LogEntry(1, "b")])
+        rl.storage.close()
+        [segment] = rl.storage.segments
+        with open(segment, "r+b") as f:
+            f.seek(-1, 2)
+            f.write(b"X")
+
+        assert RaftLog(WriteAheadLog(tmp_path)).log_entries == [
+            LogEntry(0, ""),
+            LogEntry(1, "a"),
+        ]
+
+
+class TestMappedLog:
+    def test_random_reads_across_segments(self, tmp_path):
+        wal = WriteAheadLog(tmp_path, segment_bytes=1024)
+        rl = RaftLog(wal)
+        entries = [LogEntry(i // 10, f"set key{i} {'v' * (i % 7)}") for i in range(500)]
+        rl.append_entry(0, 0, entries)
+        assert len(wal.segments) > 10
+
+        assert len(rl.log_entries) == 501
+        assert rl.log_entries[1] == entries[0]
+        assert rl.log_entries[377] == entries[376]
+        assert rl.log_entries[-1] == entries[-1]
+        assert rl.log_entries[100:105] == entries[99:104]
+        # the offset index is the only per-entry state kept in memory
+        assert wal._locations.itemsize * len(wal._locations) == 8 * 500
+
+        wal.close()
+        reloaded = RaftLog(WriteAheadLog(tmp_path)).log_entries
+        assert reloaded[250] == entries[249]
+        assert reloaded[1:] == entries
+
+    def test_truncate_and_overwrite(self, tmp_path):
+        rl = RaftLog(WriteAheadLog(tmp_path))
+        rl.append_entry(0, 0, [LogEntry(1, "a"), LogEntry(1, "b"), LogEntry(1, "c")])
+        rl.append_entry(1, 1, [LogEntry(2, "x"), LogEntry(2, "y")])
+        assert rl.log_entries == [
+            LogEntry(0, ""),
+            LogEntry(1, "a"),
+            LogEntry(2, "x"),
+            LogEntry(2, "y"),
+        ]
+        assert rl.conflict_hint(3) == (2, 2)
+
+    def test_controller_replicates_from_disk(self, tmp_path):
+        leader = RaftController(1, "LEADER", log=RaftLog(WriteAheadLog(tmp_path / "1")))
+        for i in range(200):
+            leader.receive(NewCommandMessage(f"set x {i}"))
+            leader.handle_incoming()
+        while leader.outgoing_messages.qsize():
+            leader.outgoing_messages.get_nowait()
+
+        follower = RaftController(2, log=RaftLog(WriteAheadLog(tmp_path / "2")))
+        leader.send_heartbeat()
+        exchange(leader, follower)
+        assert follower.log.log_entries == leader.log.log_entries
+
+
+# A leader with a KVServer whose first n commands have been committed
+def committed_leader(n, **options):
+    leader = RaftController(1, "LEADER", state_machine=KVServer(), **options)
+    for i in range(n):
+        leader.receive(NewCommandMessage(f"set key{i % 10} {i}"))
+        leader.handle_incoming()
+    while leader.outgoing_messages.qsize():
+        leader.outgoing_messages.get_nowait()
+    for nodenum in (2, 3):
+        leader.receive(AppendEntriesResponse(True, n, 0, nodenum))
+        leader.handle_incoming()
+    return leader
+
+
+class TestSnapshots:
+    def test_commit_applies_to_state_machine(self):
+        leader = committed_leader(25)
+        assert leader.commit_index == 25
+        assert leader.applied_index == 25
+        assert leader.state_machine.db["key4"] == "24"
+        assert leader.log.snapshot is None
+
+    def test_log_compacts_at_threshold(self):
+        leader = committed_leader(25, snapshot_threshold=20)
+        assert leader.log.snapshot_index == 25
+        assert leader.log.snapshot.data == leader.state_machine.dump()
+        assert len(leader.log.log_entries) == 26
+        assert leader.log.log_entries[25] == LogEntry(0, "")
+        try:
+            leader.log.log_entries[24]
+        except IndexError:
+            pass
+        else:
+            assert False
+
+        # the log carries on after the snapshot
+        leader.receive(NewCommandMessage("set x 1"))
+        leader.handle_incoming()
+        assert leader.log.log_entries[26] == LogEntry(0, "set x 1")
+        msg = leader.outgoing_messages.get_nowait()
+        assert msg == AppendEntriesMessage(25, 0, [LogEntry(0, "set x 1")], 25, 0)
+
+    def test_lagging_follower_gets_snapshot(self):
+        leader = committed_leader(25, snapshot_threshold=20)
+        leader.receive(NewCommandMessage("set tail 1"))
+        leader.handle_incoming()
+        leader.outgoing_messages.get_nowait()
+
+        follower = RaftController(2, state_machine=KVServer())
+        leader.send_heartbeat()
+        exchange(leader, follower)
+        assert follower.log.snapshot_index == 25
+        assert follower.applied_index == 25
+        assert follower.state_machine.db == committed_leader(25).state_machine.db
+        assert follower.log.log_entries[26] == LogEntry(0, "set tail 1")
+        assert leader.next_index[2] == 27
+
+    def test_install_snapshot_keeps_matching_suffix(self):
+        rl = RaftLog()
+        rl.append_entry(0, 0, [LogEntry(1, str(i)) for i in range(10)])
+        rl.compact(Snapshot(4, 1, b"{}"))
+        assert rl.log_entries[5:] == [LogEntry(1, str(i)) for i in range(4, 10)]
+        assert rl.conflict_hint(7) == (1, 4)
+
+        # a snapshot that disagrees with the log empties it
+        rl.compact(Snapshot(6, 2, b"{}"))
+        assert len(rl.log_entries) == 7
+        assert rl.log_entries[6] == LogEntry(2, "")
+
+    def test_append_below_snapshot(self):
+        rl = RaftLog()
+        rl.compact(Snapshot(5, 1, b"{}"))
+        entries = [LogEntry(1, str(i)) for i in range(7)]
+        assert rl.append_entry(0, 0, entries)
+        assert rl.log_entries[6:] == entries[5:]
+
+    def test_restart_from_snapshot(self, tmp_path):
+        wal = WriteAheadLog(tmp_path, segment_bytes=256)
+        leader = committed_leader(25, snapshot_threshold=20, log=RaftLog(wal))
+        leader.receive(NewCommandMessage("set tail 1"))
+        leader.handle_incoming()
+        assert len(wal.segments) == 1
+        wal.close()
+
+        restarted = RaftController(
+            1, log=RaftLog(WriteAheadLog(tmp_path)), state_machine=KVServer()
+        )
+        assert restarted.log.snapshot_index == 25
+        assert restarted.commit_index == 25
+        assert restarted.state_machine.db == leader.state_machine.db
+        assert restarted.log.log_entries[26] == LogEntry(0, "set tail 1")
+        assert len(restarted.log.log_entries) == 27
+
+
+class TestSnapshotStreaming:
+    def lagging(self, follower_log=None):
+        leader = committed_leader(
+            25, snapshot_threshold=20, snapshot_chunk_bytes=16
+        )
+        follower = RaftController(2, log=follower_log, state_machine=KVServer())
+        leader.send_heartbeat()
+        return leader, follower
+
+    def test_snapshot_sent_in_chunks(self):
+        leader, follower = self.lagging()
+        size = leader.log.snapshot.size
+        exchange(leader, follower)
+        assert follower.log.snapshot.data == leader.log.snapshot.data
+        assert follower.state_machine.db == leader.state_machine.db
+        assert leader.next_index[2] == 26
+
+        # every chunk was at most snapshot_chunk_bytes
+        leader, follower = self.lagging()
+        chunks = []
+        while leader.outgoing_messages.qsize():
+            msg = leader.outgoing_messages.get_nowait()
+            if isinstance(msg, InstallSnapshotMessage):
+                chunks.append(msg)
+            follower.handle_message(msg)
+            while follower.outgoing_messages.qsize():
+                leader.handle_message(follower.outgoing_messages.get_nowait())
+        assert len(chunks) == -(-size // 16)
+        assert [chunk.offset for chunk in chunks] == list(range(0, size, 16))
+        assert [chunk.done for chunk in chunks] == [False] * (len(chunks) - 1) + [True]
+
+    def step(self, leader, follower):
+        msg = leader.outgoing_messages.get_nowait()
+        follower.handle_message(msg)
+        leader.handle_message(follower.outgoing_messages.get_nowait())
+        return msg
+
+    def test_resumes_after_lost_chunk(self):
+        leader, follower = self.lagging()
+        for _ in range(4):
+            self.step(leader, follower)
+
+        # the connection drops with a chunk in flight, so nothing comes
+        # back until the next heartbeat finds the follower still behind
+        lost = leader.outgoing_messages.get_nowait()
+        assert lost.offset == 48
+        leader.handle_message(ClockTick(50))
+        self.step(leader, follower)
+        assert self.step(leader, follower).offset == 48
+        exchange(leader, follower)
+        assert follower.log.snapshot_index == 25
+        assert follower.state_machine.db == leader.state_machine.db
+
+    def test_follower_says_where_to_resume(self):
+        leader, follower = self.lagging()
+        for _ in range(3):
+            self.step(leader, follower)
+
+        # a leader that doesn't know how far the follower got is told
+        leader.outgoing_messages.get_nowait()
+        leader._snapshot_offsets.clear()
+        leader.replicate(2)
+        assert self.step(leader, follower).offset == 0
+        assert leader._snapshot_offsets[2] == 32
+        assert leader.outgoing_messages.get_nowait().offset == 32
+
+    def test_chunks_out_of_order_are_ignored(self):
+        rl = RaftLog()
+        assert rl.receive_snapshot(5, 1, 0, b"abc", False) == 3
+        assert rl.receive_snapshot(5, 1, 6, b"ghi", True) == 3
+        assert rl.receive_snapshot(5, 1, 0, b"abc", False) == 3
+        assert rl.snapshot is None
+        assert rl.receive_snapshot(5, 1, 3, b"def", True) == 6
+        assert rl.snapshot == Snapshot(5, 1, b"abcdef")
+
+        # a newer snapshot replaces one that is half received
+        assert rl.receive_snapshot(9, 2, 0, b"old", False) == 3
+        assert rl.receive_snapshot(12, 2, 3, b"new", True) == 0
+        assert rl.receive_snapshot(12, 2, 0, b"new", True) == 3
+        assert rl.snapshot_index == 12
+
+    def test_wal_follower_streams_to_temp_file(self, tmp_path):
+        wal = WriteAheadLog(tmp_path)
+        leader, follower = self.lagging(RaftLog(wal))
+        follower.handle_message(leader.outgoing_messages.get_nowait())
+        leader.handle_message(follower.outgoing_messages.get_nowait())
+        follower.handle_message(leader.outgoing_messages.get_nowait())
+        assert sorted(os.listdir(tmp_path)) == ["snapshot.25.tmp"]
+        resp = follower.outgoing_messages.get_nowait()
+        assert resp == InstallSnapshotResponse(0, 2, 25, 16)
+
+        leader.handle_message(resp)
+        exchange(leader, follower)
+        assert sorted(os.listdir(tmp_path)) == ["snapshot"]
+        assert follower.state_machine.db == leader.state_machine.db
+        wal.close()
+
+        restarted = RaftLog(WriteAheadLog(tmp_path))
+        assert restarted.snapshot_index == 25
+        assert restarted.snapshot.data == leader.log.snapshot.data
+
+    def test_leftover_temp_file_removed_on_load(self, tmp_path):
+        wal = WriteAheadLog(tmp_path)
+        log = RaftLog(wal)
+        log.receive_snapshot(5, 1, 0, b"partial", False)
+        assert os.listdir(tmp_path) == ["snapshot.5.tmp"]
+        RaftLog(WriteAheadLog(tmp_path))
+        assert os.listdir(tmp_path) == []
+
+
+# Deliver every node's messages to its peers, as the servers do, until
+# they all go quiet
+def deliver(nodes):
+    busy = True
+    while busy:
+        busy = False
+        for node in list(nodes.values()):
+            while node.outgoing_messages.qsize():
+                msg = node.outgoing_messages.get_nowait()
+                busy = True
+                for nodenum in node.peers:
+                    if nodenum in nodes:
+                        nodes[nodenum].handle_message(msg)
+
+
+def make_cluster(size, **options):
+    cluster = range(1, size + 1)
+    nodes = {1: RaftController(1, "LEADER", cluster=cluster, **options)}
+    for nodenum in cluster[1:]:
+        nodes[nodenum] = RaftController(nodenum, cluster=cluster, **options)
+    return nodes
+
+
+class TestMembership:
+    def test_add_node(self):
+        nodes = make_cluster(3, state_machine=KVServer())
+        leader = nodes[1]
+        leader.handle_message(NewCommandMessage("set x 1"))
+        deliver(nodes)
+
+        # a new node starts out knowing the cluster it is joining
+        nodes[4] = RaftController(4, cluster=(1, 2, 3), state_machine=KVServer())
+        assert leader.handle_message(MembershipChangeMessage(4, True))
+        assert leader.cluster == (1, 2, 3, 4)
+        assert leader.match_index.quorum == 3
+        deliver(nodes)
+
+        for node in nodes.values():
+            assert node.cluster == (1, 2, 3, 4)
+            assert node.log.log_entries == leader.log.log_entries
+        assert leader.commit_index == 2
+        assert leader.committed_cluster == (1, 2, 3, 4)
+        # configurations aren't state machine commands
+        assert nodes[4].state_machine.db == {"x": "1"}
+
+    def test_one_change_at_a_time(self):
+        nodes = make_cluster(3)
+        leader = nodes[1]
+        assert leader.handle_message(MembershipChangeMessage(4, True))
+        assert not leader.handle_message(MembershipChangeMessage(5, True))
+        deliver(nodes)
+        assert leader.commit_index == 1
+        assert leader.handle_message(MembershipChangeMessage(5, True))
+        # nothing to change
+        assert not leader.handle_message(MembershipChangeMessage(5, True))
+
+        # nor can a new leader change anything before it commits an entry
+        leader = RaftController(1, "LEADER", cluster=(1, 2, 3))
+        leader.term = 1
+        assert not leader.handle_message(MembershipChangeMessage(4, True))
+
+    def test_quorum_follows_configuration(self):
+        leader = RaftController(1, "LEADER", cluster=range(1, 6))
+        assert leader.handle_message(MembershipChangeMessage(5, False))
+        assert leader.cluster == (1, 2, 3, 4)
+        leader.update_last_applied(2, 1)
+        assert leader.commit_index == 0
+        leader.update_last_applied(3, 1)
+        assert leader.commit_index == 1
+        assert leader.handle_message(MembershipChangeMessage(4, False))
+        leader.update_last_applied(2, 2)
+        assert leader.commit_index == 2
+        # removed nodes don't count
+        leader.update_last_applied(5, 9)
+        assert leader.match_index.as_dict() == {1: 2, 2: 2, 3: 1}
+
+    def test_removed_leader_steps_down(self):
+        nodes = make_cluster(3)
+        leader = nodes[1]
+        assert leader.handle_message(MembershipChangeMessage(1, False))
+        assert leader.cluster == (2, 3)
+        deliver(nodes)
+        assert leader.commit_index == 1
+        assert leader.role == "FOLLOWER"
+
+        # and doesn't stand for election, nor get votes if it did
+        leader.handle_message(ClockTick(10000.0))
+        assert leader.role == "FOLLOWER"
+        nodes[2].handle_message(RequestVoteMessage(5, 1, 1, 0))
+        assert nodes[2].outgoing_messages.qsize() == 0
+
+    def test_election_needs_majority_of_configuration(self):
+        candidate = RaftController(1, cluster=(1, 2, 3))
+        candidate.become_candidate()
+        # votes from outside the cluster don't count
+        candidate.handle_message(RequestVoteResponse(True, 1, 7))
+        assert candidate.role == "CANDIDATE"
+        candidate.handle_message(RequestVoteResponse(True, 1, 2))
+        assert candidate.role == "LEADER"
+
+        alone = RaftController(1, cluster=(1,))
+        alone.handle_message(ClockTick(10000.0))
+        assert alone.role == "LEADER"
+
+    def test_client_cannot_propose_configuration(self):
+        leader = RaftController(1, "LEADER")
+        assert not leader.handle_message(NewCommandMessage(config_command([1])))
+        assert leader.cluster == (1, 2, 3, 4, 5)
+
+    def test_configuration_survives_snapshot(self, tmp_path):
+        wal = WriteAheadLog(tmp_path)
+        leader = RaftController(
+            1,
+            "LEADER",
+            cluster=(1, 2, 3),
+            log=RaftLog(wal),
+            state_machine=KVServer(),
+        )
+        assert leader.handle_message(MembershipChangeMessage(4, True))
+        leader.update_last_applied(2, 1)
+        leader.update_last_applied(3, 1)
+        leader.handle_message(NewCommandMessage("set x 1"))
+        leader.update_last_applied(2, 2)
+        leader.update_last_applied(3, 2)
+        assert leader.applied_index == 2
+        leader.take_snapshot()
+        assert leader.log.snapshot.config == (1, 2, 3, 4)
+        wal.close()
+
+        log = RaftLog(WriteAheadLog(tmp_path))
+        assert RaftController(1, cluster=(1, 2, 3), log=log).cluster == (1, 2, 3, 4)
+
+        # a follower that needs the snapshot learns the configuration too
+        follower = RaftController(4, cluster=(1, 2, 3), state_machine=KVServer())
+        while leader.outgoing_messages.qsize():
+            leader.outgoing_messages.get_nowait()
+        leader.next_index[4] = 1
+        leader.replicate(4)
+        msg = leader.outgoing_messages.get_nowait()
+        assert decode(encode(msg)).config == (1, 2, 3, 4)
+        follower.handle_message(msg)
+        assert follower.cluster == (1, 2, 3, 4)
+        assert follower.state_machine.db == {"x": "1"}
+
+
+class TestLearners:
+    def joined(self):
+        nodes = make_cluster(3, state_machine=KVServer())
+        leader = nodes[1]
+        for i in range(5):
+            leader.handle_message(NewCommandMessage(f"set x {i}"))
+        deliver(nodes)
+        nodes[4] = RaftController(4, cluster=(1, 2, 3), state_machine=KVServer())
+        assert leader.handle_message(MembershipChangeMessage(4, True, learner=True))
+        return nodes
+
+    def test_learner_replicates_without_voting(self):
+        nodes = self.joined()
+        leader, learner = nodes[1], nodes[4]
+        # the cluster can commit the change without the learner
+        assert leader.cluster == (1, 2, 3)
+        assert leader.match_index.quorum == 2
+        deliver(nodes)
+
+        assert learner.role == "LEARNER"
+        assert learner.learners == (4,)
+        assert learner.log.log_entries == leader.log.log_entries
+        assert learner.state_machine.db == {"x": "4"}
+        assert leader.learner_index == {4: 6}
+        assert 4 not in leader.match_index
+
+    def test_learner_never_votes_or_stands(self):
+        nodes = self.joined()
+        deliver(nodes)
+        learner = nodes[4]
+        learner.handle_message(ClockTick(10000.0))
+        assert learner.role == "LEARNER"
+        assert learner.term == 0
+        learner.handle_message(RequestVoteMessage(5, 2, 6, 0))
+        assert learner.outgoing_messages.qsize() == 0
+        # a new term from a leader leaves it a learner
+        learner.handle_message(AppendEntriesMessage(6, 0, [], 6, 5))
+        assert learner.role == "LEARNER"
+
+    def test_promotion_once_caught_up(self):
+        nodes = self.joined()
+        leader = nodes[1]
+        learner = nodes.pop(4)
+        deliver(nodes)
+        assert leader.commit_index == 6
+        # hasn't got anything yet
+        assert not leader.handle_message(MembershipChangeMessage(4, True))
+
+        nodes[4] = learner
+        leader.send_heartbeat()
+        deliver(nodes)
+        assert leader.handle_message(MembershipChangeMessage(4, True))
+        assert leader.cluster == (1, 2, 3, 4)
+        assert leader.learners == ()
+        assert leader.match_index[4] == 6
+        deliver(nodes)
+        assert learner.role == "FOLLOWER"
+        assert leader.commit_index == 7
+
+    def test_learners_kept_in_snapshot(self, tmp_path):
+        wal = WriteAheadLog(tmp_path)
+        wal.compact(Snapshot(3, 1, b"data", (1, 2, 3), (4,)))
+        wal.close()
+        log = RaftLog(WriteAheadLog(tmp_path))
+        assert log.snapshot.data == b"data"
+        node = RaftController(4, log=log)
+        assert (node.cluster, node.learners) == ((1, 2, 3), (4,))
+        assert node.role == "LEARNER"
+
+
+class TestReadIndex:
+    def cluster(self):
+        nodes = make_cluster(3, state_machine=KVServer())
+        nodes[1].handle_message(NewCommandMessage("set x 1"))
+        deliver(nodes)
+        return nodes
+
+    def read(self, controller, command):
+        future = controller.receive(ReadMessage(command))
+        controller.handle_incoming()
+        return future
+
+    def test_concurrent_reads_share_a_round(self):
+        nodes = self.cluster()
+        leader = nodes[1]
+        first = self.read(leader, "get x")
+        assert leader.read_seq == 1
+        assert not first.done()
+        # these arrive while the first round is in flight
+        rest = [self.read(leader, "get x") for _ in range(5)]
+        assert leader.read_seq == 1
+        deliver(nodes)
+        assert leader.read_seq == 2
+        assert [read.result() for read in [first] + rest] == [b"1"] * 6
+        assert len(leader.log.log_entries) == 2
+
+    def test_stale_acks_do_not_confirm(self):
+        nodes = self.cluster()
+        leader = nodes[1]
+        read = self.read(leader, "get x")
+        leader.handle_message(AppendEntriesResponse(True, 1, 0, 2, read_seq=0))
+        leader.handle_message(AppendEntriesResponse(True, 1, 0, 3, read_seq=0))
+        assert not read.done()
+        leader.handle_message(AppendEntriesResponse(True, 1, 0, 2, read_seq=1))
+        assert read.result() == b"1"
+
+    def test_new_leader_waits_for_its_own_commit(self):
+        nodes = make_cluster(3, state_machine=KVServer())
+        nodes[1].handle_message(NewCommandMessage("set x 1"))
+        deliver(nodes)
+        nodes[1].become_follower()
+        candidate = nodes[2]
+        candidate.become_candidate()
+        candidate.handle_message(RequestVoteResponse(True, 1, 3))
+        assert candidate.leader
+        # the entry that starts its term hasn't committed yet
+        read = self.read(candidate, "get x")
+        assert candidate.read_seq == 0
+        deliver(nodes)
+        assert candidate.commit_index == 2
+        assert read.result() == b"1"
+
+    def test_only_the_leader_reads(self):
+        nodes = self.cluster()
+        assert nodes[2].receive(ReadMessage("get x")) == NOT_LEADER
+
+        leader = nodes[1]
+        read = self.read(leader, "get x")
+        leader.handle_message(AppendEntriesMessage(1, 0, [], 1, 1))
+        assert read.result() == NOT_LEADER
+
+    def test_async_server_answers_reads(self):
+        async def run():
+            server = AsyncRaftServer(1, leader=True, cluster=(1,))
+            await server.start()
+            reader, writer = await asyncio.open_connection(*SERVERS[1])
+            write_message(writer, pickle.dumps(NewCommandMessage("set x 1")))
+            assert await read_message(reader) == b"ok"
+            write_message(writer, pickle.dumps(ReadMessage("get x")))
+            resp = await read_message(reader)
+            writer.close()
+            await server.stop()
+            return resp
+
+        assert asyncio.run(run()) == b"1"
+
+
+class TestLeaseReads:
+    def cluster(self, **options):
+        nodes = make_cluster(3, state_machine=KVServer(), lease_reads=True, **options)
+        leader = nodes[1]
+        leader.handle_message(NewCommandMessage("set x 1"))
+        deliver(nodes)
+        # the heartbeat on each tick renews the lease
+        leader.handle_message(ClockTick(50.0))
+        deliver(nodes)
+        return nodes
+
+    def read(self, controller, command):
+        future = controller.receive(ReadMessage(command))
+        controller.handle_incoming()
+        return future
+
+    def test_reads_served_locally_under_lease(self):
+        nodes = self.cluster()
+        leader = nodes[1]
+        assert leader.lease_valid
+        seq = leader.read_seq
+        assert self.read(leader, "get x").result() == b"1"
+        assert leader.read_seq == seq
+        assert leader.outgoing_messages.qsize() == 0
+
+    def test_lease_expires_without_quorum(self):
+        nodes = self.cluster()
+        leader = nodes[1]
+        # lease is 500ms less 10% drift less a tick from when it started
+        for _ in range(7):
+            leader.handle_message(ClockTick(50.0))
+        assert leader.lease_valid
+        leader.handle_message(ClockTick(50.0))
+        assert not leader.lease_valid
+
+        # so reads go back to confirming with a round
+        read = self.read(leader, "get x")
+        assert not read.done()
+        deliver(nodes)
+        assert read.result() == b"1"
+        assert leader.lease_valid
+
+    def test_clock_drift_shortens_lease(self):
+        leader = self.cluster(max_clock_drift=0.5)[1]
+        for _ in range(3):
+            leader.handle_message(ClockTick(50.0))
+        assert leader.lease_valid
+        leader.handle_message(ClockTick(50.0))
+        assert not leader.lease_valid
+
+    def test_followers_stick_with_leader(self):
+        nodes = self.cluster()
+        follower = nodes[2]
+        follower.handle_message(RequestVoteMessage(5, 3, 2, 0))
+        assert follower.outgoing_messages.qsize() == 0
+        assert follower.term == 0
+
+        for _ in range(5):
+            follower.handle_message(ClockTick(100.0))
+        follower.handle_message(RequestVoteMessage(5, 3, 2, 0))
+        assert follower.outgoing_messages.get_nowait() == RequestVoteResponse(
+            True, 5, 2
+        )
@@ -0,0 +1,442 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from array import array
+
+from log import LogEntry, Snapshot
+
+# Each record is a header then the utf-8 command.  The checksum covers
+# everything after itself, so a torn or corrupted record is detected.
+#
+#   crc32 (4) | command length (4) | index (8) | term (8) | command
+_RECORD = struct.Struct(">IIqq")
+_CRC = struct.Struct(">I")
+_BODY = struct.Struct(">Iqq")
+
+# The snapshot file is a header, the cluster configuration then the
+# state machine data.  It is replaced atomically, so it is either the
+# old snapshot or the new one.
+#
+#   index (8) | term (8) | crc32 of data (4) | voter count (4) |
+#   learner count (4) | voters then learners (8 each) | data
+_SNAPSHOT = struct.Struct(">qqIII")
+
+# Snapshots are checked and copied this many bytes at a time, so a large
+# one is never read into memory whole
+_CHUNK = 1 << 20
+
+# An entry's location is its segment number and file offset packed into
+# one 64-bit value: 24 bits of segment, 40 bits (1TB) of offset.
+_OFFSET_BITS = 40
+_OFFSET_MASK = (1 << _OFFSET_BITS) - 1
+
+
+class WriteAheadLog:
+    # Segmented, append-only storage for a RaftLog.
+    #
+    # Records are written to numbered segment files in the directory and
+    # a new segment is started once the current one reaches
+    # segment_bytes.  Every record carries its log index, and replay
+    # treats a record as replacing the entry at its index and everything
+    # after it, so truncating the log never rewrites old segments.
+    #
+    # Entries are read back through mmaps of the segments.  An array of
+    # packed (segment, offset) locations maps a log index to its record,
+    # so memory use is 8 bytes an entry however big the commands are.
+    #
+    # append() writes records but doesn't make them durable.  commit()
+    # flushes them and fsyncs, so a batch of entries costs one fsync.
+    # With fsync_window > 0 a commit only fsyncs if the last fsync is at
+    # least that many seconds old, trading the durability of that
+    # window for fewer syncs.
+    #
+    # compact() saves a snapshot next to the segments and deletes the
+    # segments it makes redundant.  The log then starts after the
+    # snapshot and records up to it are ignored on replay.  A snapshot
+    # streamed from the leader is written to a temporary file by a
+    # SnapshotWriter and moved into place by install().  Either way the
+    # data stays on disk and is read back through a StoredSnapshot.
+    def __init__(self, directory, segment_bytes=64 << 20, fsync_window=0.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_window = fsync_window
+        os.makedirs(directory, exist_ok=True)
+
+        self._locations = array("Q")
+        self.snapshot = None
+        self._maps = {}
+        self._file = None
+        self._seq = None
+        self._next_seq = 0
+        self._last_sync = float("-inf")
+        self._dirty = False
+        self.fsyncs = 0
+        self.records = 0
+
+    @property
+    def segments(self):
+        names = [name for name in os.listdir(self.directory) if name.endswith(".wal")]
+        return sorted(os.path.join(self.directory, name) for name in names)
+
+    @property
+    def first_index(self):
+        return self.snapshot.index if self.snapshot is not None else 0
+
+    @property
+    def last_index(self):
+        return self.first_index + len(self._locations)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot")
+
+    # Replay every segment to rebuild the offset index and return the
+    # log as a MappedEntries view.  A torn record at the end of the last
+    # segment is cut off.
+    def load(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        self.snapshot = self._load_snapshot()
+        self._locations = array("Q")
+        first = self.first_index
+        segments = self.segments
+        for path in segments:
+            seq = _seq(path)
+            data = self._mapped(seq, 0)
+            offset = 0
+            for index, start, end in read_records(data):
+                offset = end
+                if index <= first:
+                    continue
+                del self._locations[index - 1 - first :]
+                self._locations.append(seq << _OFFSET_BITS | start)
+            if offset != len(data):
+                if path != segments[-1]:
+                    raise IOError(f"Corrupt record in {path} at offset {offset}")
+                self._unmap(seq)
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+        return MappedEntries(self)
+
+    def _load_snapshot(self):
+        try:
+            f = open(self.snapshot_path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            index, term, crc, voters, learners = _SNAPSHOT.unpack(
+                f.read(_SNAPSHOT.size)
+            )
+            config = struct.unpack(f">{voters}q", f.read(8 * voters))
+            learners = struct.unpack(f">{learners}q", f.read(8 * learners))
+            start = f.tell()
+            check = 0
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                check = zlib.crc32(chunk, check)
+            size = f.tell() - start
+        if check != crc:
+            raise IOError(f"Corrupt snapshot in {self.snapshot_path}")
+        return StoredSnapshot(self.snapshot_path, index, term, size, config, learners)
+
+    # Save the snapshot and drop the log up to it
+    def compact(self, snapshot: Snapshot):
+        writer = self.snapshot_writer(
+            snapshot.index, snapshot.term, snapshot.config, snapshot.learners
+        )
+        for offset in range(0, snapshot.size, _CHUNK):
+            writer.write(snapshot.read(offset, _CHUNK))
+        self.install(writer)
+
+    # A writer for a snapshot that arrives in chunks
+    def snapshot_writer(self, index, term, config=(), learners=()):
+        path = os.path.join(self.directory, f"snapshot.{index}.tmp")
+        return SnapshotWriter(path, index, term, config, learners)
+
+    # Atomically replace our snapshot with the one the writer has
+    # finished, then drop the log up to it.  Entries after it are kept
+    # if the log agrees with the snapshot, otherwise the log is emptied
+    # down to it.
+    def install(self, writer):
+        writer.close()
+        os.replace(writer.path, self.snapshot_path)
+        _fsync_directory(self.directory)
+        snapshot = StoredSnapshot(
+            self.snapshot_path,
+            writer.index,
+            writer.term,
+            writer.received,
+            writer.config,
+            writer.learners,
+        )
+
+        first = self.first_index
+        if (
+            first <= snapshot.index <= self.last_index
+            and self.read_term(snapshot.index) == snapshot.term
+        ):
+            del self._locations[: snapshot.index - first]
+        else:
+            self._locations = array("Q")
+        self.snapshot = snapshot
+
+        # Segments before the one holding the first live entry only hold
+        # records that are now in the snapshot or were overwritten
+        if self._locations:
+            live = self._locations[0] >> _OFFSET_BITS
+        else:
+            live = self._seq + 1 if self._seq is not None else 0
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+        for path in self.segments:
+            seq = _seq(path)
+            if seq < live:
+                self._unmap(seq)
+                os.remove(path)
+        if self._file is None:
+            self._seq = None
+            self._next_seq = live
+
+    def read_term(self, index):
+        if index == self.first_index:
+            return self.snapshot.term if self.snapshot is not None else 0
+        return self.read(index).term
+
+    def read(self, index) -> LogEntry:
+        location = self._locations[index - 1 - self.first_index]
+        seq, offset = location >> _OFFSET_BITS, location & _OFFSET_MASK
+        data = self._mapped(seq, offset + _RECORD.size)
+        _, size, _, term = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        data = self._mapped(seq, start + size)
+        return LogEntry(term, data[start : start + size].decode("utf-8"))
+
+    # Write entries starting at index, replacing anything from there on
+    def append(self, index, entries):
+        self.truncate(index)
+        for entry in entries:
+            f = self._segment()
+            command = entry.command.encode("utf-8")
+            body = _BODY.pack(len(command), index, entry.term) + command
+            self._locations.append(self._seq << _OFFSET_BITS | f.tell())
+            f.write(_CRC.pack(zlib.crc32(body)) + body)
+            self.records += 1
+            self._dirty = True
+            index += 1
+
+    # Forget entries from index on.  This only becomes durable when the
+    # next append writes a record at that index.
+    def truncate(self, index):
+        del self._locations[index - 1 - self.first_index :]
+
+    def commit(self):
+        if self._file is not None:
+            self._file.flush()
+        if self._dirty and time.monotonic() - self._last_sync >= self.fsync_window:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.fsyncs += 1
+            self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for seq in list(self._maps):
+            self._unmap(seq)
+
+    # The segment to write to, rotating to a new one when it is full
+    def _segment(self):
+        if self._file is not None:
+            if self._file.tell() < self.segment_bytes:
+                return self._file
+            self.sync()
+            self._file.close()
+            path = self._segment_path(self._seq + 1)
+        else:
+            segments = self.segments
+            if not segments:
+                path = self._segment_path(self._next_seq)
+            elif os.path.getsize(segments[-1]) < self.segment_bytes:
+                path = segments[-1]
+            else:
+                path = self._segment_path(_seq(segments[-1]) + 1)
+        self._seq = self._next_seq = _seq(path)
+        self._file = open(path, "ab")
+        return self._file
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:08d}.wal")
+
+    # A read-only map of a segment covering at least end bytes.  The
+    # segment being written to grows, so it is remapped when a read goes
+    # past the end of its current map.
+    def _mapped(self, seq, end):
+        data = self._maps.get(seq)
+        if data is not None and len(data) >= end:
+            return data
+        if seq == self._seq and self._file is not None:
+            self._file.flush()
+        self._unmap(seq)
+        with open(self._segment_path(seq), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[seq] = data
+        return data
+
+    def _unmap(self, seq):
+        data = self._maps.pop(seq, None)
+        if data is not None:
+            data.close()
+
+
+class MappedEntries:
+    # A list-like view of a WriteAheadLog, used as RaftLog.log_entries.
+    # Index 0, or the snapshot's index once the log is compacted, is an
+    # empty sentinel carrying the snapshot's term.  Every later entry is
+    # read from its segment on demand.  Changes are written to the log.
+    def __init__(self, wal):
+        self.wal = wal
+
+    def __len__(self):
+        return self.wal.last_index + 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[idx] for idx in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not self.wal.first_index <= key < len(self):
+            raise IndexError("log index out of range")
+        if key == self.wal.first_index:
+            return LogEntry(self.wal.read_term(key), "")
+        return self.wal.read(key)
+
+    # Only dropping the end of the log, del entries[idx:], is supported
+    def __delitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        if stop != len(self) or step != 1:
+            raise ValueError("Can only delete the end of the log")
+        self.wal.truncate(max(start, self.wal.first_index + 1))
+
+    def append(self, entry):
+        self.wal.append(len(self), [entry])
+
+    def extend(self, entries):
+        self.wal.append(len(self), entries)
+
+    def __iter__(self):
+        for idx in range(self.wal.first_index, len(self)):
+            yield self[idx]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class StoredSnapshot:
+    # A snapshot saved in a WriteAheadLog's directory.  Only its header
+    # is kept in memory and the data is read from the file on demand.
+    def __init__(self, path, index, term, size, config=(), learners=()):
+        self.path = path
+        self.index = index
+        self.term = term
+        self.size = size
+        self.config = tuple(config)
+        self.learners = tuple(learners)
+
+    @property
+    def data(self):
+        return self.read(0, self.size)
+
+    def read(self, offset, size):
+        with open(self.path, "rb") as f:
+            nodes = len(self.config) + len(self.learners)
+            f.seek(_SNAPSHOT.size + 8 * nodes + offset)
+            return f.read(size)
+
+    def __repr__(self):
+        return (
+            f"StoredSnapshot(index={self.index}, term={self.term}, "
+            f"size={self.size}, config={self.config}, learners={self.learners})"
+        )
+
+
+class SnapshotWriter:
+    # Writes a snapshot to a temporary file a chunk at a time, keeping a
+    # running checksum so the data never has to be read back.  The
+    # checksum goes in the header once the last chunk is written.
+    def __init__(self, path, index, term, config=(), learners=()):
+        self.path = path
+        self.index = index
+        self.term = term
+        self.config = tuple(config)
+        self.learners = tuple(learners)
+        self.received = 0
+        self._crc = 0
+        self._file = open(path, "wb")
+        self._file.write(self._header())
+
+    def write(self, data):
+        self._file.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self.received += len(data)
+
+    # Finish the file and make it durable, ready to be moved into place
+    def close(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+    def _header(self):
+        nodes = self.config + self.learners
+        header = _SNAPSHOT.pack(
+            self.index, self.term, self._crc, len(self.config), len(self.learners)
+        )
+        return header + struct.pack(f">{len(nodes)}q", *nodes)
+
+
+def _seq(path):
+    return int(os.path.basename(path).split(".")[0])
+
+
+# Make a rename in the directory durable
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Yield (index, start offset, end offset) for each intact record,
+# stopping at the first short or corrupt one
+def read_records(data, offset=0):
+    while offset + _RECORD.size <= len(data):
+        crc, size, index, term = _RECORD.unpack_from(data, offset)
+        end = offset + _RECORD.size + size
+        if end > len(data) or zlib.crc32(data[offset + 4 : end]) != crc:
+            return
+        yield index, offset, end
+        offset = end